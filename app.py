@@ -6,39 +6,184 @@
 
 import os
 import io
+import re
+import sys
+import asyncio
+import tempfile
+import glob
+import copy
 import json
+import math
+import queue
+import atexit
+import multiprocessing
 import base64
+import hashlib
+import shutil
+import sqlite3
+import bisect
+import itertools
 import subprocess
 import threading
 import time
 import uuid
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, CancelledError, wait
+from urllib.parse import parse_qs
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from flask import Flask, render_template_string, request, jsonify
-from PIL import Image
+from flask import Flask, Response, render_template_string, request, jsonify, send_file
+from PIL import Image, ImageOps
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 可选：装了 pillow-heif 后能读 HEIC/HEIF（iPhone 照片）
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
 
 app = Flask(__name__)
 
 CONFIG_FILE = Path(__file__).parent.parent / 'output' / 'watermark_config.json'
+# 缩略图/预览小图的磁盘缓存
+PROXY_CACHE_DIR = CONFIG_FILE.parent / 'proxy_cache'
+PROXY_CACHE_MAX_FILES = 5000
+# HEIC/HEIF 完整解码一次后把像素存成 PPM，预览和导出共用，超过上限时删最久没用的
+DECODE_CACHE_DIR = CONFIG_FILE.parent / 'decode_cache'
+DECODE_CACHE_MAX_MB = int(os.environ.get('WM_DECODE_CACHE_MB', 4096))
+# 分块上传的照片按内容hash存放，重复导出时不用再传；超过上限时删最久没用的
+BLOB_DIR = CONFIG_FILE.parent / 'blobs'
+BLOB_STORE_MAX_MB = int(os.environ.get('WM_BLOB_STORE_MB', 20480))
+# 任务状态和每张照片的进度，服务重启后没做完的任务接着做；结束的任务保留 TASK_KEEP_DAYS 天
+TASK_DB = CONFIG_FILE.parent / 'tasks.db'
+TASK_KEEP_DAYS = 7
+# 上传过的水印按内容hash存放，导出时只传hash
+WATERMARK_DIR = CONFIG_FILE.parent / 'watermarks'
 export_tasks = {}
+# 每个任务已经导出完的文件，按完成顺序，供 /task_download 打包；不放进 export_tasks，免得进度推送越来越大
+task_outputs = {}
+
+# 导出进程池大小，默认使用全部CPU核心
+EXPORT_WORKERS = int(os.environ.get('WM_EXPORT_WORKERS', 0)) or os.cpu_count() or 1
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+# 同时执行的导出任务数，其余排队；结束的任务状态保留多少秒
+JOB_WORKERS = int(os.environ.get('WM_JOB_WORKERS', 2))
+TASK_TTL = 60
+# 每个任务最多记录多少条失败照片
+MAX_TASK_ERRORS = 100
+
+# 每个工作进程最多缓存多少份处理好的水印，以及这些水印合计占多少内存；
+# 间距小的平铺水印是和照片一样大的整层，两三份就到上限
+WATERMARK_CACHE_SIZE = 64
+WATERMARK_CACHE_MAX_MB = int(os.environ.get('WM_WATERMARK_CACHE_MB', 256))
+# 各工作进程水印缓存命中情况的汇总
+wm_cache_stats = {'hits': 0, 'misses': 0}
+
+# 水印混合方式：pillow 或 numpy（向量化实现，没装numpy时退回pillow）
+# 实测 pillow 的 paste 更快（见 bench.py blend），默认仍用 pillow
+BLEND_BACKEND = os.environ.get('WM_BLEND_BACKEND', 'pillow')
+if BLEND_BACKEND == 'numpy' and np is None:
+    print('[Export] numpy 未安装，水印混合使用 pillow')
+    BLEND_BACKEND = 'pillow'
+
+def _default_memory_budget():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+# 导出各步骤计时（/metrics 和 /task_status 里的 metrics），设为0关闭
+METRICS_ENABLED = os.environ.get('WM_METRICS', '1') != '0'
+
+# 所有任务同时在处理的照片估算占用的内存上限（MB），默认物理内存的一半，0 为不限制
+MEMORY_BUDGET_MB = int(os.environ.get('WM_MEMORY_BUDGET_MB', 0)) or _default_memory_budget()
 
 default_config = {
     'landscape': {'x': 95, 'y': 95, 'size': 15, 'opacity': 80},
     'portrait': {'x': 95, 'y': 95, 'size': 12, 'opacity': 80}
 }
 
-def load_config():
-    if CONFIG_FILE.exists():
+# 输出设置，存在配置的 output 里；format 为 original 时按原图格式输出
+# max_edge 为 0 表示不缩小；subsampling 可选 4:4:4 / 4:2:2 / 4:2:0，auto 用编码器默认
+default_output = {
+    'format': 'original', 'quality': 95, 'progressive': False, 'optimize': False,
+    'subsampling': 'auto', 'max_edge': 0
+}
+OUTPUT_FORMATS = {'jpeg': ('JPEG', '.jpg'), 'webp': ('WEBP', '.webp'), 'avif': ('AVIF', '.avif'), 'png': ('PNG', '.png')}
+
+# 保存配置后多久写盘，这段时间内的多次保存合并成一次
+CONFIG_FLUSH_DELAY = 0.5
+
+class ConfigStore:
+    """配置放在内存里，保存只改内存
+
+    第一次修改后 delay 秒统一写盘一次，先写临时文件再改名，不会留下写了一半的文件。
+    进程退出时把没写的也写掉。
+    """
+
+    def __init__(self, path, delay=CONFIG_FLUSH_DELAY):
+        self.path = path
+        self.delay = delay
+        self._config = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._config is None:
+                self._config = self._read()
+            return copy.deepcopy(self._config)
+
+    def put(self, config):
+        with self._lock:
+            self._config = copy.deepcopy(config)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if self._timer is None:
+                    return
+                self._timer.cancel()
+                self._timer = None
+                data = json.dumps(self._config, indent=2)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+    def _read(self):
         try:
-            with open(CONFIG_FILE, 'r') as f:
+            with open(self.path, 'r') as f:
                 return json.load(f)
-        except:
-            pass
-    return default_config.copy()
+        except (OSError, ValueError):
+            return copy.deepcopy(default_config)
+
+config_store = ConfigStore(CONFIG_FILE)
+atexit.register(config_store.flush)
+
+def load_config():
+    return config_store.get()
 
 def save_config(config):
-    CONFIG_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=2)
+    config_store.put(config)
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -160,6 +305,11 @@ HTML_TEMPLATE = '''
             background: transparent; color: #888; font-size: 11px; cursor: pointer;
         }
         .position-btn:hover { border-color: rgba(255,255,255,0.3); color: #fff; }
+        .setting-select {
+            width: 100%; padding: 6px 8px; background: rgba(255,255,255,0.05); color: #fff;
+            border: 1px solid rgba(255,255,255,0.15); border-radius: 6px; font-size: 12px; outline: none;
+        }
+        .setting-select option { background: #1a1a2e; }
 
         /* 任务队列 */
         .task-queue { position: fixed; bottom: 20px; right: 20px; width: 300px; z-index: 1000; }
@@ -176,6 +326,13 @@ HTML_TEMPLATE = '''
         .task-progress { height: 3px; background: rgba(255,255,255,0.1); border-radius: 2px; overflow: hidden; }
         .task-progress-bar { height: 100%; background: linear-gradient(90deg, #f093fb, #f5576c); transition: width 0.3s; }
         .task-info { font-size: 10px; color: #666; margin-top: 6px; }
+        .task-info.has-errors { color: #f5576c; cursor: help; }
+        .task-cancel {
+            margin-left: 6px; border: none; background: transparent; color: #666; font-size: 11px; cursor: pointer;
+        }
+        .task-cancel:hover { color: #ef4444; }
+        .task-download { margin-left: 6px; color: #666; font-size: 11px; text-decoration: none; }
+        .task-download:hover { color: #22c55e; }
     </style>
 </head>
 <body>
@@ -238,6 +395,27 @@ HTML_TEMPLATE = '''
                     </div>
                 </div>
 
+                <div class="setting-group">
+                    <div class="setting-label">排列</div>
+                    <select id="modeSelect" class="setting-select" onchange="updateMode()">
+                        <option value="single">单个</option>
+                        <option value="tile">平铺（斜向重复铺满）</option>
+                    </select>
+                </div>
+
+                <div id="tileSettings" style="display:none;">
+                    <div class="setting-group">
+                        <div class="setting-label"><span>间距</span><span class="setting-value"><span id="spacingValue">50</span>%</span></div>
+                        <input type="range" id="spacingSlider" min="0" max="200" value="50" oninput="updateSetting('spacing', this.value)">
+                    </div>
+
+                    <div class="setting-group">
+                        <div class="setting-label"><span>角度</span><span class="setting-value"><span id="angleValue">30</span>°</span></div>
+                        <input type="range" id="angleSlider" min="-90" max="90" value="30" oninput="updateSetting('angle', this.value)">
+                    </div>
+                </div>
+
+                <div id="placeSettings">
                 <div class="setting-group">
                     <div class="setting-label"><span>X 位置</span><span class="setting-value"><span id="xValue">95</span>%</span></div>
                     <input type="range" id="xSlider" min="-20" max="120" value="95" oninput="updateSetting('x', this.value)">
@@ -262,6 +440,7 @@ HTML_TEMPLATE = '''
                         <button class="position-btn" onclick="setPos(95,95)">右下</button>
                     </div>
                 </div>
+                </div>
 
                 <div class="setting-group">
                     <div class="setting-label"><span>大小</span><span class="setting-value"><span id="sizeValue">15</span>%</span></div>
@@ -273,8 +452,45 @@ HTML_TEMPLATE = '''
                     <input type="range" id="opacitySlider" min="10" max="100" value="80" oninput="updateSetting('opacity', this.value)">
                 </div>
 
+                <div class="setting-group">
+                    <label class="setting-label" style="cursor:pointer;justify-content:flex-start;gap:6px;">
+                        <input type="checkbox" id="onlyThisPhoto"> 仅用于这张照片
+                    </label>
+                </div>
+
                 <div style="font-size:10px;color:#555;text-align:center;margin-top:10px;">
-                    横图/竖图设置分别保存
+                    横图/竖图（或按宽高比匹配的预设）设置分别保存
+                </div>
+
+                <div class="settings-title" style="margin-top:20px;">输出设置</div>
+
+                <div class="setting-group">
+                    <div class="setting-label">格式</div>
+                    <select id="outFormat" class="setting-select" onchange="updateOutput()">
+                        <option value="original">原格式</option>
+                        <option value="jpeg">JPEG</option>
+                        <option value="webp">WebP</option>
+                        <option value="avif">AVIF</option>
+                        <option value="png">PNG</option>
+                    </select>
+                </div>
+
+                <div class="setting-group">
+                    <div class="setting-label"><span>质量</span><span class="setting-value" id="qualityValue">95</span></div>
+                    <input type="range" id="qualitySlider" min="50" max="100" value="95"
+                        oninput="document.getElementById('qualityValue').textContent = this.value" onchange="updateOutput()">
+                </div>
+
+                <div class="setting-group">
+                    <div class="setting-label">最长边</div>
+                    <select id="outMaxEdge" class="setting-select" onchange="updateOutput()">
+                        <option value="0">原尺寸</option>
+                        <option value="4096">4096</option>
+                        <option value="2560">2560</option>
+                        <option value="2048">2048</option>
+                        <option value="1440">1440</option>
+                        <option value="1080">1080</option>
+                    </select>
                 </div>
             </div>
         </div>
@@ -286,15 +502,34 @@ HTML_TEMPLATE = '''
         let photos = [];
         let currentIdx = -1;
         let watermarkImg = null;
-        let watermarkBase64 = null;
+        let watermarkRef = null; // 服务端登记的水印hash；上传失败时退回 base64
         let config = {{ config | tojson }};
         let sourceDir = '';
 
         const canvas = document.getElementById('previewCanvas');
         const ctx = canvas.getContext('2d');
 
+        // 输出设置（格式/质量/最长边），和水印设置一起保存在配置里
+        config.output = Object.assign({format: 'original', quality: 95, max_edge: 0}, config.output || {});
+        document.getElementById('outFormat').value = config.output.format;
+        document.getElementById('qualitySlider').value = config.output.quality;
+        document.getElementById('qualityValue').textContent = config.output.quality;
+        document.getElementById('outMaxEdge').value = config.output.max_edge;
+
+        function updateOutput() {
+            config.output.format = document.getElementById('outFormat').value;
+            config.output.quality = parseInt(document.getElementById('qualitySlider').value);
+            config.output.max_edge = parseInt(document.getElementById('outMaxEdge').value);
+            document.getElementById('qualityValue').textContent = config.output.quality;
+            fetch('/save_config', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(config)
+            });
+        }
+
         async function loadFolder(input) {
-            const files = Array.from(input.files).filter(f => /\\.(jpg|jpeg|png|heic)$/i.test(f.name));
+            const files = Array.from(input.files).filter(f => /\\.(jpg|jpeg|png|heic|heif)$/i.test(f.name));
             if (!files.length) { alert('未找到图片'); return; }
 
             if (files[0].webkitRelativePath) {
@@ -314,7 +549,7 @@ HTML_TEMPLATE = '''
         }
 
         function loadFiles(input) {
-            const files = Array.from(input.files).filter(f => /\\.(jpg|jpeg|png|heic)$/i.test(f.name));
+            const files = Array.from(input.files).filter(f => /\\.(jpg|jpeg|png|heic|heif)$/i.test(f.name));
             if (!files.length) return;
             initPhotos(files);
         }
@@ -323,6 +558,8 @@ HTML_TEMPLATE = '''
             photos = files.map(f => ({
                 file: f,
                 name: f.name,
+                // 文件夹内的相对路径（去掉最外层文件夹名），按路径导出时用
+                relPath: f.webkitRelativePath ? f.webkitRelativePath.split('/').slice(1).join('/') : null,
                 url: URL.createObjectURL(f),
                 selected: true,
                 orientation: null,
@@ -342,9 +579,12 @@ HTML_TEMPLATE = '''
                 div.className = 'thumb-item' + (p.selected ? ' selected' : '') + (i === currentIdx ? ' viewing' : '');
                 div.innerHTML = `
                     <div class="thumb-checkbox" data-idx="${i}"></div>
-                    <img class="thumb-img" src="${p.url}">
+                    <img class="thumb-img">
                     <span class="thumb-name">${p.name}</span>
                 `;
+                const thumb = div.querySelector('.thumb-img');
+                thumb.onerror = () => { thumb.onerror = null; thumb.src = p.url; };
+                proxyUrl(p, THUMB_SIZE).then(url => thumb.src = url, () => thumb.src = p.url);
                 // 复选框点击
                 div.querySelector('.thumb-checkbox').onclick = (e) => {
                     e.stopPropagation();
@@ -359,6 +599,46 @@ HTML_TEMPLATE = '''
             document.getElementById('totalCount').textContent = photos.length;
         }
 
+        // 缩略图和预览都用服务端生成的小图，导出仍然用原图
+        const THUMB_SIZE = 120;
+        const PREVIEW_SIZE = Math.min(2560, Math.ceil(Math.max(screen.width, screen.height) * (window.devicePixelRatio || 1)));
+        const proxyJobs = [];
+        let proxyActive = 0;
+
+        function proxyUrl(photo, size) {
+            if (sourceDir && photo.relPath) {
+                const url = '/proxy?dir=' + encodeURIComponent(sourceDir) +
+                    '&name=' + encodeURIComponent(photo.relPath) + '&size=' + size;
+                // 缩略图直接用地址；预览要从响应头读原图尺寸
+                if (size !== PREVIEW_SIZE) return Promise.resolve(url);
+                return fetch(url).then(resp => readProxy(photo, resp));
+            }
+            // 不是按文件夹打开的，把文件传给服务端生成，最多同时4个请求
+            return new Promise((resolve, reject) => {
+                proxyJobs.push({photo, size, resolve, reject});
+                runProxyJobs();
+            });
+        }
+
+        function runProxyJobs() {
+            while (proxyActive < 4 && proxyJobs.length) {
+                const job = proxyJobs.shift();
+                proxyActive++;
+                fetch('/proxy?size=' + job.size, { method: 'POST', body: job.photo.file })
+                    .then(resp => readProxy(job.photo, resp))
+                    .then(job.resolve, job.reject)
+                    .finally(() => { proxyActive--; runProxyJobs(); });
+            }
+        }
+
+        // 记下原图显示方向的尺寸（X-Photo-Size），横竖图和预设按它判断，返回小图的 blob 地址
+        function readProxy(photo, resp) {
+            if (!resp.ok) return Promise.reject(new Error(resp.status));
+            const m = /^(\\d+)x(\\d+)$/.exec(resp.headers.get('X-Photo-Size') || '');
+            if (m) photo.size = {width: +m[1], height: +m[2]};
+            return resp.blob().then(blob => URL.createObjectURL(blob));
+        }
+
         function viewPhoto(idx) {
             if (currentIdx >= 0 && photos[currentIdx]?.orientation) {
                 saveCurrentSettings();
@@ -374,19 +654,50 @@ HTML_TEMPLATE = '''
             const img = new Image();
             img.onload = () => {
                 photo.img = img;
-                photo.orientation = img.width > img.height ? 'landscape' : 'portrait';
-                loadSettingsForOrientation(photo.orientation);
+                // 按原图尺寸判断；没拿到时（小图加载失败）img 就是原图
+                const {width, height} = photo.size || img;
+                photo.orientation = width > height ? 'landscape' : 'portrait';
+                photo.preset = matchPreset(width, height);
+                loadSettings(photo);
                 renderPreview();
                 document.getElementById('exportCurrentBtn').disabled = false;
-                document.getElementById('orientationBadge').textContent = photo.orientation === 'landscape' ? '横图' : '竖图';
+                document.getElementById('orientationBadge').textContent =
+                    (photo.preset ? photo.preset.name : (photo.orientation === 'landscape' ? '横图' : '竖图')) +
+                    (photoOverride(photo) ? '（单独设置）' : '');
             };
-            img.src = photo.url;
+            img.onerror = () => { img.onerror = null; img.src = photo.url; };
+            if (!photo.previewUrl) {
+                photo.previewUrl = proxyUrl(photo, PREVIEW_SIZE).catch(() => photo.url);
+            }
+            photo.previewUrl.then(url => img.src = url);
             document.getElementById('placeholder').style.display = 'none';
             canvas.style.display = 'block';
         }
 
-        function loadSettingsForOrientation(orientation) {
-            const s = config[orientation];
+        // 和服务端 PresetTable 一样：按顺序第一个 min_ratio <= 宽/高 < max_ratio 的预设，都不匹配时用横图/竖图设置
+        function matchPreset(w, h) {
+            const ratio = w / h;
+            return (config.presets || []).find(p => (p.min_ratio || 0) <= ratio &&
+                (p.max_ratio == null || ratio < p.max_ratio)) || null;
+        }
+
+        function photoOverride(photo) {
+            return (config.overrides || {})[photo.name] || null;
+        }
+
+        // 生效的设置：单张覆盖 > 覆盖里指定的预设 > 匹配的预设 > 横图/竖图
+        function effectiveSettings(photo) {
+            const o = photoOverride(photo);
+            const named = o?.preset && (config.presets || []).find(p => p.name === o.preset);
+            const s = Object.assign({x: 95, y: 95, size: 15, opacity: 80, mode: 'single', spacing: 50, angle: 30},
+                named || photo.preset || config[photo.orientation], o || {});
+            return {x: s.x, y: s.y, size: s.size, opacity: s.opacity, mode: s.mode,
+                    spacing: s.spacing, angle: s.angle, watermark: s.watermark || null};
+        }
+
+        function loadSettings(photo) {
+            const s = effectiveSettings(photo);
+            document.getElementById('onlyThisPhoto').checked = !!photoOverride(photo);
             document.getElementById('xSlider').value = s.x;
             document.getElementById('xValue').textContent = s.x;
             document.getElementById('ySlider').value = s.y;
@@ -395,17 +706,47 @@ HTML_TEMPLATE = '''
             document.getElementById('sizeValue').textContent = s.size;
             document.getElementById('opacitySlider').value = s.opacity;
             document.getElementById('opacityValue').textContent = s.opacity;
+            document.getElementById('spacingSlider').value = s.spacing;
+            document.getElementById('spacingValue').textContent = s.spacing;
+            document.getElementById('angleSlider').value = s.angle;
+            document.getElementById('angleValue').textContent = s.angle;
+            document.getElementById('modeSelect').value = s.mode;
+            showModeSettings();
+        }
+
+        function showModeSettings() {
+            const tiled = document.getElementById('modeSelect').value === 'tile';
+            document.getElementById('tileSettings').style.display = tiled ? '' : 'none';
+            document.getElementById('placeSettings').style.display = tiled ? 'none' : '';
+        }
+
+        function updateMode() {
+            showModeSettings();
+            renderPreview();
         }
 
         function saveCurrentSettings() {
             const photo = photos[currentIdx];
             if (!photo?.orientation) return;
-            config[photo.orientation] = {
+            const s = {
                 x: parseInt(document.getElementById('xSlider').value),
                 y: parseInt(document.getElementById('ySlider').value),
                 size: parseInt(document.getElementById('sizeSlider').value),
-                opacity: parseInt(document.getElementById('opacitySlider').value)
+                opacity: parseInt(document.getElementById('opacitySlider').value),
+                mode: document.getElementById('modeSelect').value
             };
+            if (s.mode === 'tile') {
+                s.spacing = parseInt(document.getElementById('spacingSlider').value);
+                s.angle = parseInt(document.getElementById('angleSlider').value);
+            }
+            if (document.getElementById('onlyThisPhoto').checked) {
+                config.overrides = config.overrides || {};
+                config.overrides[photo.name] = Object.assign({}, photoOverride(photo), s);
+            } else {
+                if (config.overrides) delete config.overrides[photo.name];
+                if (photo.preset) Object.assign(photo.preset, s);
+                else config[photo.orientation] = s;
+            }
             fetch('/save_config', {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
@@ -423,16 +764,45 @@ HTML_TEMPLATE = '''
                 document.getElementById('watermarkPreview').style.display = 'block';
                 document.getElementById('watermarkPlaceholder').style.display = 'none';
                 document.getElementById('watermarkUpload').classList.add('has-image');
-                const c = document.createElement('canvas');
-                c.width = img.width; c.height = img.height;
-                c.getContext('2d').drawImage(img, 0, 0);
-                watermarkBase64 = c.toDataURL('image/png');
                 renderPreview();
-                updateCounts(); // 启用导出按钮
+                registerWatermark(file, img);
             };
             img.src = URL.createObjectURL(file);
         }
 
+        // 水印只上传一次，导出时只带 hash
+        async function registerWatermark(file, img) {
+            watermarkRef = null;
+            updateCounts();
+            try {
+                const formData = new FormData();
+                formData.append('watermark', file);
+                const result = await (await fetch('/watermark', { method: 'POST', body: formData })).json();
+                if (!result.key) throw new Error(result.error || '未知错误');
+                watermarkRef = result.key;
+            } catch (e) {
+                console.warn('水印上传失败，导出时改为直接带上水印:', e);
+                const c = document.createElement('canvas');
+                c.width = img.width; c.height = img.height;
+                c.getContext('2d').drawImage(img, 0, 0);
+                watermarkRef = c.toDataURL('image/png');
+            }
+            updateCounts(); // 启用导出按钮
+        }
+
+        // 预设或单张覆盖指定了水印hash时，预览用服务端登记的那个水印
+        const presetWatermarks = {};
+        function previewWatermark(photo) {
+            const hash = effectiveSettings(photo).watermark;
+            if (!hash) return watermarkImg;
+            if (!presetWatermarks[hash]) {
+                presetWatermarks[hash] = new Image();
+                presetWatermarks[hash].onload = renderPreview;
+                presetWatermarks[hash].src = '/watermark/' + hash;
+            }
+            return presetWatermarks[hash].complete && presetWatermarks[hash].naturalWidth ? presetWatermarks[hash] : null;
+        }
+
         function renderPreview() {
             const photo = photos[currentIdx];
             if (!photo?.img) return;
@@ -441,25 +811,51 @@ HTML_TEMPLATE = '''
             canvas.height = img.height;
             ctx.drawImage(img, 0, 0);
 
-            if (watermarkImg) {
+            const wmImg = previewWatermark(photo);
+            if (wmImg) {
                 const x = parseInt(document.getElementById('xSlider').value);
                 const y = parseInt(document.getElementById('ySlider').value);
                 const size = parseInt(document.getElementById('sizeSlider').value);
                 const opacity = parseInt(document.getElementById('opacitySlider').value) / 100;
 
                 const wmW = img.width * size / 100;
-                const wmH = wmW * (watermarkImg.height / watermarkImg.width);
+                const wmH = wmW * (wmImg.height / wmImg.width);
+                if (document.getElementById('modeSelect').value === 'tile') {
+                    ctx.globalAlpha = opacity;
+                    drawTiled(wmImg, img.width, img.height, wmW, wmH,
+                        parseInt(document.getElementById('spacingSlider').value),
+                        parseInt(document.getElementById('angleSlider').value));
+                    ctx.globalAlpha = 1;
+                    return;
+                }
                 const maxX = img.width - wmW;
                 const maxY = img.height - wmH;
                 const posX = maxX * x / 100;
                 const posY = maxY * y / 100;
 
                 ctx.globalAlpha = opacity;
-                ctx.drawImage(watermarkImg, posX, posY, wmW, wmH);
+                ctx.drawImage(wmImg, posX, posY, wmW, wmH);
                 ctx.globalAlpha = 1;
             }
         }
 
+        // 和服务端 prepare_tiled_watermark 一样：以照片中心为原点，格距为水印宽高加 间距% * 水印宽，
+        // 整个网格逆时针旋转 angle 度（canvas 的 y 轴向下，rotate 传负角度）
+        function drawTiled(wmImg, w, h, wmW, wmH, spacing, angle) {
+            const gap = wmW * Math.max(spacing, 0) / 100;
+            const stepX = wmW + gap, stepY = wmH + gap;
+            const n = Math.floor(Math.hypot(w, h) / 2 / Math.min(stepX, stepY)) + 2;
+            ctx.save();
+            ctx.translate(w / 2, h / 2);
+            ctx.rotate(-angle * Math.PI / 180);
+            for (let j = -n; j <= n; j++) {
+                for (let i = -n; i <= n; i++) {
+                    ctx.drawImage(wmImg, i * stepX - wmW / 2, j * stepY - wmH / 2, wmW, wmH);
+                }
+            }
+            ctx.restore();
+        }
+
         function updateSetting(key, value) {
             document.getElementById(key + 'Value').textContent = value;
             renderPreview();
@@ -489,12 +885,12 @@ HTML_TEMPLATE = '''
             const count = photos.filter(p => p.selected).length;
             document.getElementById('selectedCount').textContent = count;
             document.getElementById('exportCount').textContent = count;
-            document.getElementById('exportSelectedBtn').disabled = count === 0 || !watermarkBase64;
+            document.getElementById('exportSelectedBtn').disabled = count === 0 || !watermarkRef;
         }
 
         // 导出当前单张
         async function exportCurrent() {
-            if (!watermarkBase64 || currentIdx < 0) {
+            if (!watermarkRef || currentIdx < 0) {
                 alert('请先上传水印图片'); return;
             }
             saveCurrentSettings();
@@ -504,7 +900,7 @@ HTML_TEMPLATE = '''
 
         // 导出选中的
         async function exportSelected() {
-            if (!watermarkBase64) {
+            if (!watermarkRef) {
                 alert('请先上传水印图片'); return;
             }
             saveCurrentSettings();
@@ -521,9 +917,155 @@ HTML_TEMPLATE = '''
                 exportPath = sourceDir ? (sourceDir + '/watermarked') : '';
             }
 
+            // 打开的是文件夹时直接让服务端按路径读原图，不用再上传一遍
+            if (sourceDir && photoList.every(p => p.relPath)) {
+                try {
+                    const resp = await fetch('/export_paths', {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json'},
+                        body: JSON.stringify({
+                            source_dir: sourceDir,
+                            filenames: photoList.map(p => p.relPath),
+                            export_path: exportPath,
+                            watermark: watermarkRef,
+                            config: config
+                        })
+                    });
+                    const result = await resp.json();
+                    if (result.task_id) {
+                        addTaskUI(result.task_id, taskName, photoList.length);
+                        watchTask(result.task_id);
+                        return;
+                    }
+                    console.warn('按路径导出不可用，改为上传:', result.error);
+                } catch (e) {
+                    console.warn('按路径导出失败，改为上传:', e);
+                }
+            }
+            // 能算hash时按内容分块上传，已经传过的照片不再传，断了也能接着传
+            if (window.crypto?.subtle) {
+                blobExport(photoList, taskName, exportPath);
+            } else {
+                uploadExport(photoList, taskName, exportPath);
+            }
+        }
+
+        function newTaskId() {
+            return Array.from(crypto.getRandomValues(new Uint8Array(5)), b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        async function photoHash(p) {
+            if (!p.hash) {
+                const digest = await crypto.subtle.digest('SHA-1', await p.file.arrayBuffer());
+                p.hash = Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+            }
+            return p.hash;
+        }
+
+        const BLOB_CHUNK = 8 * 1024 * 1024;
+        const cancelledUploads = new Set();
+
+        // 从服务端记录的位置开始分块上传，失败重试时先问服务端收到了多少
+        async function uploadBlob(p, onProgress) {
+            let offset = (await (await fetch('/blobs/' + p.hash)).json()).offset;
+            let retries = 0;
+            while (offset < p.file.size) {
+                const end = Math.min(offset + BLOB_CHUNK, p.file.size);
+                try {
+                    const resp = await fetch(`/blobs/${p.hash}?offset=${offset}&total=${p.file.size}`, {
+                        method: 'PUT', body: p.file.slice(offset, end)
+                    });
+                    const result = await resp.json();
+                    if (resp.status === 409) {
+                        offset = result.offset;
+                        continue;
+                    }
+                    if (result.error) throw new Error(result.error);
+                    onProgress(result.offset - offset);
+                    offset = result.offset;
+                    retries = 0;
+                    if (result.complete) break;
+                } catch (e) {
+                    if (++retries > 5) throw e;
+                    await new Promise(r => setTimeout(r, 500 * retries));
+                    offset = (await (await fetch('/blobs/' + p.hash)).json()).offset;
+                }
+            }
+        }
+
+        async function blobExport(photoList, taskName, exportPath) {
+            const taskId = newTaskId();
+            addTaskUI(taskId, taskName, photoList.length);
+            const el = document.getElementById('task-' + taskId);
+            const setInfo = (text, pct) => {
+                el.querySelector('.task-info').textContent = text;
+                if (pct != null) el.querySelector('.task-progress-bar').style.width = pct + '%';
+            };
+            const fail = (msg) => {
+                cancelledUploads.delete(taskId);
+                el.remove();
+                if (msg) alert(msg);
+            };
+            try {
+                for (let i = 0; i < photoList.length; i++) {
+                    if (cancelledUploads.has(taskId)) return fail();
+                    setInfo(`计算校验 ${i + 1} / ${photoList.length}`);
+                    await photoHash(photoList[i]);
+                }
+                let resp = await fetch('/blobs/check', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({hashes: [...new Set(photoList.map(p => p.hash))]})
+                });
+                const missing = new Set((await resp.json()).missing);
+                const pending = [], seen = new Set();
+                photoList.forEach(p => {
+                    if (missing.has(p.hash) && !seen.has(p.hash)) { seen.add(p.hash); pending.push(p); }
+                });
+
+                const totalBytes = pending.reduce((n, p) => n + p.file.size, 0);
+                let sent = 0;
+                const next = pending.slice();
+                const worker = async () => {
+                    while (next.length) {
+                        if (cancelledUploads.has(taskId)) return;
+                        await uploadBlob(next.shift(), n => {
+                            sent += n;
+                            const pct = Math.round(sent / totalBytes * 100);
+                            setInfo(`上传 ${pct}% · ${photoList.length - pending.length} 张已在服务端`, pct);
+                        });
+                    }
+                };
+                await Promise.all(Array.from({length: Math.min(3, pending.length)}, worker));
+                if (cancelledUploads.has(taskId)) return fail();
+
+                setInfo('0 / ' + photoList.length, 0);
+                resp = await fetch('/export_blobs', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({
+                        task_id: taskId,
+                        photos: photoList.map(p => ({hash: p.hash, name: p.name})),
+                        export_path: exportPath,
+                        watermark: watermarkRef,
+                        config: config
+                    })
+                });
+                const result = await resp.json();
+                if (!result.task_id) return fail('启动失败: ' + (result.error || '未知错误'));
+                if (result.task_id !== taskId) el.id = 'task-' + result.task_id;
+                el.querySelector('.task-cancel').setAttribute('onclick', `cancelTask('${result.task_id}')`);
+                el.querySelector('.task-download').href = '/task_download/' + result.task_id;
+                watchTask(result.task_id);
+            } catch (e) {
+                fail('导出失败: ' + e.message);
+            }
+        }
+
+        async function uploadExport(photoList, taskName, exportPath) {
             const formData = new FormData();
             formData.append('export_path', exportPath);
-            formData.append('watermark', watermarkBase64);
+            formData.append('watermark', watermarkRef);
             formData.append('config', JSON.stringify(config));
             formData.append('count', photoList.length);
 
@@ -531,16 +1073,19 @@ HTML_TEMPLATE = '''
                 formData.append('photo_' + i, p.file);
             });
 
+            // 流式上传：服务端收到一张就处理一张，task_id 先在前端生成，上传期间就能看到进度
+            const taskId = newTaskId();
+            addTaskUI(taskId, taskName, photoList.length);
+            watchTask(taskId);
             try {
-                const resp = await fetch('/export_start', { method: 'POST', body: formData });
+                const resp = await fetch('/export_stream?task_id=' + taskId, { method: 'POST', body: formData });
                 const result = await resp.json();
-                if (result.task_id) {
-                    addTaskUI(result.task_id, taskName, photoList.length);
-                    pollTask(result.task_id);
-                } else {
+                if (!result.task_id) {
+                    document.getElementById('task-' + taskId)?.remove();
                     alert('启动失败: ' + (result.error || '未知错误'));
                 }
             } catch (e) {
+                document.getElementById('task-' + taskId)?.remove();
                 alert('导出失败: ' + e.message);
             }
         }
@@ -553,7 +1098,12 @@ HTML_TEMPLATE = '''
             div.innerHTML = `
                 <div class="task-header">
                     <span class="task-title">${name}</span>
-                    <span class="task-status processing">处理中</span>
+                    <span>
+                        <span class="task-status processing">处理中</span>
+                        <a class="task-download" href="/task_download/${taskId}" title="下载 ZIP（导出过程中就可以开始下载）" hidden
+                           onclick="this.closest('.task-item').dataset.downloaded = 1">⬇</a>
+                        <button class="task-cancel" title="取消" onclick="cancelTask('${taskId}')">✕</button>
+                    </span>
                 </div>
                 <div class="task-progress"><div class="task-progress-bar" style="width:0%"></div></div>
                 <div class="task-info">0 / ${total}</div>
@@ -561,25 +1111,97 @@ HTML_TEMPLATE = '''
             queue.appendChild(div);
         }
 
-        async function pollTask(taskId) {
-            try {
-                const resp = await fetch('/task_status/' + taskId);
-                const data = await resp.json();
-                const el = document.getElementById('task-' + taskId);
-                if (!el) return;
+        function cancelTask(taskId) {
+            cancelledUploads.add(taskId);
+            fetch('/task_cancel/' + taskId, { method: 'POST' });
+        }
 
-                const pct = Math.round((data.current / data.total) * 100);
-                el.querySelector('.task-progress-bar').style.width = pct + '%';
-                el.querySelector('.task-info').textContent = data.message || (data.current + ' / ' + data.total);
+        // 进度优先用 SSE 推送，一个连接覆盖所有任务；浏览器不支持或连不上时退回轮询
+        let useSSE = !!window.EventSource;
+        let eventSource = null;
+        let sseConnected = false;
+        const watchedTasks = new Set();
 
-                if (data.status === 'done') {
-                    el.querySelector('.task-status').className = 'task-status done';
-                    el.querySelector('.task-status').textContent = '完成';
+        function watchTask(taskId) {
+            watchedTasks.add(taskId);
+            if (!useSSE) { pollTask(taskId); return; }
+            if (!eventSource) openEventStream();
+        }
+
+        function openEventStream() {
+            eventSource = new EventSource('/events');
+            eventSource.onopen = () => { sseConnected = true; };
+            eventSource.addEventListener('task', (e) => {
+                const data = JSON.parse(e.data);
+                if (watchedTasks.has(data.task_id) && updateTaskUI(data.task_id, data)) {
+                    watchedTasks.delete(data.task_id);
+                }
+            });
+            eventSource.onerror = () => {
+                if (sseConnected) return; // 连上过的断线由 EventSource 自动重连
+                eventSource.close();
+                eventSource = null;
+                useSSE = false;
+                watchedTasks.forEach(pollTask);
+            };
+        }
+
+        // 返回 true 表示任务已经结束
+        function updateTaskUI(taskId, data) {
+            const el = document.getElementById('task-' + taskId);
+            if (!el) return true;
+            if (data.status === 'not_found') {
+                // 上传还没到第一张照片，任务尚未创建
+                return false;
+            }
+
+            el.querySelector('.task-download')?.removeAttribute('hidden');
+            const pct = Math.round((data.current / data.total) * 100);
+            el.querySelector('.task-progress-bar').style.width = pct + '%';
+            let info = data.message || (data.current + ' / ' + data.total);
+            if (data.photo_seconds != null) info += ' · ' + data.photo_seconds.toFixed(2) + 's';
+            if (data.failed && data.status === 'processing') info += ' · 失败 ' + data.failed + ' 张';
+            el.querySelector('.task-info').textContent = info;
+            if (data.errors?.length) {
+                // 鼠标悬停显示失败的照片和原因
+                el.title = data.errors.map(e => e.photo + ': ' + e.error).join('\\n');
+                el.querySelector('.task-info').classList.add('has-errors');
+            }
+
+            const statusEl = el.querySelector('.task-status');
+            if (data.status === 'done') {
+                statusEl.className = 'task-status ' + (data.failed ? 'error' : 'done');
+                statusEl.textContent = data.failed ? '部分失败' : '完成';
+                // 有失败的照片、或者结果还没下载时不自动消失，点 ✕ 关掉
+                if (!data.failed && el.dataset.downloaded) {
+                    el.querySelector('.task-cancel')?.remove();
                     setTimeout(() => el.remove(), 4000);
-                } else if (data.status === 'error') {
-                    el.querySelector('.task-status').className = 'task-status error';
-                    el.querySelector('.task-status').textContent = '失败';
                 } else {
+                    const close = el.querySelector('.task-cancel');
+                    close.title = '关闭';
+                    close.onclick = () => el.remove();
+                }
+            } else if (data.status === 'cancelled') {
+                statusEl.className = 'task-status error';
+                statusEl.textContent = '已取消';
+                el.querySelector('.task-cancel')?.remove();
+                setTimeout(() => el.remove(), 4000);
+            } else if (data.status === 'error') {
+                statusEl.className = 'task-status error';
+                statusEl.textContent = '失败';
+                el.querySelector('.task-cancel')?.remove();
+            } else {
+                statusEl.textContent = data.status === 'queued' ? '排队中' : '处理中';
+                return false;
+            }
+            return true;
+        }
+
+        async function pollTask(taskId) {
+            try {
+                const resp = await fetch('/task_status/' + taskId);
+                const data = await resp.json();
+                if (!updateTaskUI(taskId, data)) {
                     setTimeout(() => pollTask(taskId), 300);
                 }
             } catch (e) {
@@ -610,6 +1232,424 @@ def save_config_route():
     save_config(request.get_json())
     return jsonify({'success': True})
 
+def resolve_export_path(export_path):
+    export_path = (export_path or '').strip()
+    if not export_path or export_path == '/watermarked':
+        export_path = str(Path.home() / 'Desktop' / 'watermarked')
+    return export_path
+
+def watermark_file(wm_key):
+    return WATERMARK_DIR / f'{wm_key}.png'
+
+class WatermarkRegistry:
+    """水印登记处：PNG 按 sha1 存到 WATERMARK_DIR，最近用过的几个连同解码好的RGBA留在内存
+
+    导出请求只带 hash，工作进程按 hash 从磁盘读，不用每个任务、每张照片都传一遍水印。
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        """登记一份PNG，返回 (hash, RGBA图片)；不是有效图片时抛异常"""
+        wm_key = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            if wm_key in self._items:
+                self._items.move_to_end(wm_key)
+                return wm_key, self._items[wm_key]
+        wm = Image.open(io.BytesIO(data))
+        wm.load()
+        wm = wm.convert('RGBA')
+        path = watermark_file(wm_key)
+        if not path.exists():
+            WATERMARK_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex[:6]}')
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        self._remember(wm_key, wm)
+        return wm_key, wm
+
+    def get(self, wm_key):
+        """按 hash 取 RGBA 水印，没有登记过返回 None"""
+        if not re.fullmatch(r'[0-9a-f]{40}', wm_key or ''):
+            return None
+        with self._lock:
+            wm = self._items.get(wm_key)
+            if wm is not None:
+                self._items.move_to_end(wm_key)
+                return wm
+        path = watermark_file(wm_key)
+        if not path.exists():
+            return None
+        wm = Image.open(path).convert('RGBA')
+        self._remember(wm_key, wm)
+        return wm
+
+    def resolve(self, watermark):
+        """导出请求里的 watermark：hash，或者旧的 base64 / data URL，返回 hash"""
+        if self.get(watermark) is not None:
+            return watermark
+        if re.fullmatch(r'[0-9a-f]{40}', watermark or ''):
+            raise ValueError('水印不存在，请重新上传')
+        if watermark.startswith('data:'):
+            watermark = watermark.split(',')[1]
+        return self.put(base64.b64decode(watermark))[0]
+
+    def _remember(self, wm_key, wm):
+        with self._lock:
+            self._items[wm_key] = wm
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+watermarks = WatermarkRegistry()
+
+@app.route('/watermark', methods=['POST'])
+def upload_watermark():
+    """上传水印，返回 hash，之后导出时 watermark 字段只传这个 hash"""
+    try:
+        f = request.files.get('watermark')
+        data = f.read() if f else request.get_data()
+        if not data:
+            return jsonify({'error': '没有水印文件'})
+        wm_key, wm = watermarks.put(data)
+        return jsonify({'key': wm_key, 'width': wm.width, 'height': wm.height})
+    except Exception as e:
+        return jsonify({'error': f'水印图片无效: {e}'})
+
+@app.route('/watermark/<wm_key>')
+def get_watermark_file(wm_key):
+    if watermarks.get(wm_key) is None:
+        return jsonify({'error': '水印不存在'}), 404
+    return send_file(watermark_file(wm_key), mimetype='image/png', max_age=31536000)
+
+class TaskEvents:
+    """任务进度广播，给 /events 的 SSE 连接推送
+
+    每个订阅者一个队列，task_id 为 None 表示订阅全部任务。
+    传了 loop 时返回 asyncio.Queue，事件通过 loop 线程安全地放进去（ASGI 模式用）。
+    订阅者处理不过来时丢弃事件，不阻塞导出。
+    """
+
+    def __init__(self):
+        self._subs = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id=None, loop=None):
+        q = queue.Queue(maxsize=1000) if loop is None else asyncio.Queue(maxsize=1000)
+        with self._lock:
+            self._subs[q] = (task_id, loop)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.pop(q, None)
+
+    def publish(self, task_id, **extra):
+        task = export_tasks.get(task_id)
+        if task is None:
+            return
+        event = dict(task, task_id=task_id, **extra)
+        with self._lock:
+            subs = [(q, loop) for q, (tid, loop) in self._subs.items() if tid is None or tid == task_id]
+        for q, loop in subs:
+            if loop is None:
+                _put_event(q, event)
+            else:
+                try:
+                    loop.call_soon_threadsafe(_put_event, q, event)
+                except RuntimeError:
+                    # 事件循环已经关闭
+                    pass
+
+def _put_event(q, event):
+    try:
+        q.put_nowait(event)
+    except (queue.Full, asyncio.QueueFull):
+        pass
+
+def task_snapshot(task_id=None):
+    """SSE 连上时先发的当前状态；指定任务已经不在内存里时按 task_state 发任务库里的状态或 not_found"""
+    if task_id:
+        return [dict(task_state(task_id), task_id=task_id)]
+    return [dict(export_tasks[t], task_id=t) for t in list(export_tasks) if t in export_tasks]
+
+def task_state(task_id):
+    """内存里没有（重启前的任务、别的进程的任务）时从任务库读"""
+    return export_tasks.get(task_id) or task_store.get(task_id) or {'status': 'not_found'}
+
+def sse_message(event):
+    return f'event: task\ndata: {json.dumps(event, ensure_ascii=False)}\n\n'
+
+def is_finished(event):
+    """任务之后不会再有事件：已经结束，或者根本不存在"""
+    return event['status'] in ('done', 'error', 'cancelled', 'not_found')
+
+task_events = TaskEvents()
+
+def finish_task(task_id, status, message):
+    task = export_tasks[task_id]
+    task['status'] = status
+    task['message'] = message
+    task['finished_at'] = time.time()
+    task_store.save(task_id, task)
+    blobs.release(task_id)
+    task_events.publish(task_id)
+
+class TaskStore:
+    """任务状态和每张照片的处理结果存到 SQLite（WAL 模式）
+
+    export_tasks 仍是内存里的热数据，状态每次变化都写一份到这里。重启后没做完的任务
+    由 resume_tasks 重新排队，从第一张没处理的照片接着做；/task_status 查不到内存里的任务时读这里。
+    连接用到时才打开，导出工作进程和命令行批量导出不会碰数据库。
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY, status TEXT NOT NULL, state TEXT NOT NULL, args TEXT NOT NULL,
+            priority INTEGER NOT NULL, created_at REAL NOT NULL, finished_at REAL);
+        CREATE TABLE IF NOT EXISTS photos (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL, path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', out_name TEXT, entry TEXT, error TEXT,
+            UNIQUE (task_id, path));
+        CREATE INDEX IF NOT EXISTS photos_by_task ON photos (task_id, status);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # WAL 下 NORMAL 只在检查点时 fsync，每张照片一次提交不会拖慢导出
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(self.SCHEMA)
+            self._db = db
+        return self._db
+
+    def create(self, task_id, task, args, priority):
+        """args 同 ExportScheduler.submit；照片是列表时一次全部登记，上传中的照片由 do_export 逐张登记"""
+        photo_paths, export_path, watermark_data, cfg, temp_dir = args
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.execute('DELETE FROM photos WHERE task_id = ?', (task_id,))
+                db.execute('INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                           (task_id, task['status'], _task_json(task),
+                            json.dumps([export_path, watermark_data, cfg, str(temp_dir) if temp_dir else None]),
+                            priority, time.time()))
+                if isinstance(photo_paths, (list, tuple)):
+                    db.executemany('INSERT OR IGNORE INTO photos (task_id, path) VALUES (?, ?)',
+                                   [(task_id, p) for p in photo_paths])
+
+    def save(self, task_id, task):
+        with self._lock:
+            self._conn().execute('UPDATE tasks SET status = ?, state = ?, finished_at = ? WHERE task_id = ?',
+                                 (task['status'], _task_json(task), task.get('finished_at'), task_id))
+
+    def add_photo(self, task_id, path):
+        with self._lock:
+            self._conn().execute('INSERT OR IGNORE INTO photos (task_id, path) VALUES (?, ?)', (task_id, path))
+
+    def photo_done(self, task_id, path, status, task=None, out_name=None, entry=None, error=None):
+        """记下一张照片的结果（exported / skipped / failed / cancelled），和任务进度一起提交"""
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.execute('UPDATE photos SET status = ?, out_name = ?, entry = ?, error = ? '
+                           'WHERE task_id = ? AND path = ?',
+                           (status, out_name, entry and json.dumps(entry, ensure_ascii=False), error, task_id, path))
+                if task is not None:
+                    db.execute('UPDATE tasks SET status = ?, state = ? WHERE task_id = ?',
+                               (task['status'], _task_json(task), task_id))
+
+    def get(self, task_id):
+        with self._lock:
+            row = self._conn().execute('SELECT state FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return row and json.loads(row[0])
+
+    def completed(self, task_id):
+        """已经处理过的照片，按处理顺序：[(路径, 结果, 输出文件名, 清单记录, 错误)]"""
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT path, status, out_name, entry, error FROM photos "
+                "WHERE task_id = ? AND status != 'pending' ORDER BY seq", (task_id,)).fetchall()
+        return [(p, st, out, entry and json.loads(entry), err) for p, st, out, entry, err in rows]
+
+    def outputs(self, task_id):
+        """任务导出（或内容未变跳过）的输出文件路径，按处理顺序；任务不存在时返回 None"""
+        with self._lock:
+            db = self._conn()
+            row = db.execute('SELECT args FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return None
+            out_dir = Path(json.loads(row[0])[0])
+            return [str(out_dir / name) for name, in db.execute(
+                "SELECT out_name FROM photos WHERE task_id = ? AND status IN ('exported', 'skipped') "
+                "ORDER BY seq", (task_id,))]
+
+    def unfinished(self):
+        """排队中或处理中的任务：[(task_id, 状态, args, 优先级, 还没处理的照片)]"""
+        with self._lock:
+            db = self._conn()
+            tasks = db.execute("SELECT task_id, state, args, priority FROM tasks "
+                               "WHERE status IN ('queued', 'processing') ORDER BY created_at").fetchall()
+            result = []
+            for task_id, state, args, priority in tasks:
+                pending = [p for p, in db.execute("SELECT path FROM photos WHERE task_id = ? AND status = 'pending' "
+                                                   "ORDER BY seq", (task_id,))]
+                result.append((task_id, json.loads(state), json.loads(args), priority, pending))
+        return result
+
+    def prune(self, days):
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            db = self._conn()
+            with db:
+                db.execute('DELETE FROM photos WHERE task_id IN '
+                           '(SELECT task_id FROM tasks WHERE finished_at < ?)', (cutoff,))
+                db.execute('DELETE FROM tasks WHERE finished_at < ?', (cutoff,))
+
+def _task_json(task):
+    # 统计数据只在本进程有意义，不存
+    return json.dumps({k: v for k, v in task.items() if k != 'metrics'}, ensure_ascii=False)
+
+task_store = TaskStore(TASK_DB)
+
+class ExportScheduler:
+    """导出任务调度：固定数量的执行线程 + 优先级队列
+
+    单张导出（导出当前）优先级高，会排到批量任务前面；同优先级先进先出。
+    边上传边导出的任务（照片是迭代器）大部分时间在等上传，不占执行线程，单独起线程执行，
+    照片仍然经过同一个进程池和内存预算。
+    结束的任务在 export_tasks 里保留 TASK_TTL 秒后清理。
+    """
+
+    def __init__(self, workers=JOB_WORKERS, ttl=TASK_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._cancels = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, task_id, args, total, priority, state=None):
+        """args 为 do_export 除 task_id 以外的参数，最后一个是临时目录
+
+        state 是重启后从任务库恢复的任务状态，进度接着算。
+        """
+        self._cancels[task_id] = threading.Event()
+        task = export_tasks[task_id] = {'status': 'queued', 'current': 0, 'total': total, 'message': '排队中...'}
+        if state is None:
+            task_store.create(task_id, task, args, priority)
+        else:
+            task.update(current=state.get('current', 0), message='重启后继续，排队中...')
+            task_store.save(task_id, task)
+        task_events.publish(task_id)
+        if not isinstance(args[0], (list, tuple)):
+            t = threading.Thread(target=self._run_upload, args=(task_id, args), name=f'export-upload-{task_id}')
+            t.daemon = True
+            t.start()
+            return
+        self._queue.put((priority, next(self._seq), task_id, args))
+        with self._lock:
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, name=f'export-job-{len(self._threads)}')
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def cancel(self, task_id):
+        task = export_tasks.get(task_id)
+        cancel = self._cancels.get(task_id)
+        if task is None or cancel is None or task['status'] not in ('queued', 'processing'):
+            return False
+        cancel.set()
+        # 还没开始的直接标记取消，执行中的由 do_export 自己收尾
+        if task['status'] == 'queued':
+            finish_task(task_id, 'cancelled', '已取消')
+        return True
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            try:
+                _, _, task_id, args = self._queue.get(timeout=self.ttl / 2)
+            except queue.Empty:
+                self.cleanup()
+                continue
+            self._execute(task_id, args)
+            self.cleanup()
+
+    def _run_upload(self, task_id, args):
+        self._execute(task_id, args)
+        self.cleanup()
+
+    def _execute(self, task_id, args):
+        # 排队时被取消的任务可能已经过了TTL被清理掉
+        cancel = self._cancels.get(task_id)
+        if cancel is None or cancel.is_set():
+            temp_dir = args[-1]
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+        export_tasks[task_id]['status'] = 'processing'
+        export_tasks[task_id]['message'] = '准备中...'
+        task_store.save(task_id, export_tasks[task_id])
+        task_events.publish(task_id)
+        do_export(task_id, *args, cancel=cancel)
+
+    def cleanup(self):
+        now = time.time()
+        for task_id, task in list(export_tasks.items()):
+            if task.get('finished_at') and now - task['finished_at'] > self.ttl:
+                export_tasks.pop(task_id, None)
+                task_outputs.pop(task_id, None)
+                self._cancels.pop(task_id, None)
+
+scheduler = ExportScheduler()
+
+def start_export(task_id, photo_paths, total, export_path, watermark_data, cfg, temp_dir):
+    scheduler.submit(task_id, (photo_paths, export_path, watermark_data, cfg, temp_dir),
+                     total, priority=0 if total == 1 else 1)
+
+def resume_tasks():
+    """启动时把上次没做完的任务重新排队，从第一张没处理的照片接着做"""
+    task_store.prune(TASK_KEEP_DAYS)
+    for task_id, state, args, priority, pending in task_store.unfinished():
+        export_path, watermark_data, cfg, temp_dir = args
+        temp_dir = Path(temp_dir) if temp_dir else None
+        if temp_dir is not None and temp_dir.is_dir():
+            # 处理完的临时文件都删掉了，剩下的就是没处理的；上传收完但还没轮到的照片任务库里还没有，
+            # 按收到的先后（写完的时间）补登记，之后的处理结果才记得下来
+            known = set(pending)
+            received = sorted((f for f in temp_dir.rglob('*')
+                               if f.is_file() and not f.name.startswith('.') and str(f) not in known),
+                              key=lambda f: f.stat().st_mtime_ns)
+            for f in received:
+                task_store.add_photo(task_id, str(f))
+                pending.append(str(f))
+        photo_paths = []
+        for p in pending:
+            if os.path.exists(p):
+                photo_paths.append(p)
+            else:
+                task_store.add_photo(task_id, p)
+                task_store.photo_done(task_id, p, 'failed', error='重启后照片已不存在')
+        # 按 hash 导出的任务，临时目录里是指向照片存储的符号链接
+        blobs.hold(task_id, [Path(os.readlink(p)).name for p in photo_paths if os.path.islink(p)])
+        print(f"[Export] Resuming task {task_id}: {len(photo_paths)} photos left")
+        scheduler.submit(task_id, (photo_paths, export_path, watermark_data, cfg, temp_dir),
+                         state.get('total', len(photo_paths)), priority, state=state)
+
 @app.route('/export_start', methods=['POST'])
 def export_start():
     try:
@@ -617,9 +1657,7 @@ def export_start():
         if count == 0:
             return jsonify({'error': '没有照片'})
 
-        export_path = request.form.get('export_path', '').strip()
-        if not export_path or export_path == '/watermarked':
-            export_path = str(Path.home() / 'Desktop' / 'watermarked')
+        export_path = resolve_export_path(request.form.get('export_path', ''))
         print(f"[Export] Received export_path: {export_path}, count: {count}")
         watermark_data = request.form.get('watermark', '')
         cfg = json.loads(request.form.get('config', '{}'))
@@ -636,90 +1674,1924 @@ def export_start():
                 photo_paths.append(str(p))
 
         task_id = uuid.uuid4().hex[:10]
-        export_tasks[task_id] = {'status': 'processing', 'current': 0, 'total': len(photo_paths), 'message': '准备中...'}
+        start_export(task_id, photo_paths, len(photo_paths), export_path, watermark_data, cfg, temp_dir)
+
+        return jsonify({'task_id': task_id})
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        return jsonify({'error': str(e)})
+
+def resolve_source(root, name):
+    """源文件夹内的文件路径，不存在或用 ../ 跳出源文件夹时返回 None"""
+    p = (Path(root) / name).resolve()
+    if Path(root).resolve() not in p.parents or not p.is_file():
+        return None
+    return p
+
+_path_hashes = {}
+
+def file_hash(p):
+    """按修改时间和大小记住已算过的hash，同一文件反复请求小图时不用每次读全文件"""
+    st = p.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _path_hashes.get(str(p))
+    if cached and cached[0] == key:
+        return cached[1]
+    h = hashlib.sha1(p.read_bytes()).hexdigest()
+    _path_hashes[str(p)] = (key, h)
+    return h
+
+# HEIC/HEIF 文件头 ftyp 后面的品牌
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1')
+_decode_cache_writes = 0
+
+def open_photo(src, content_hash=None, draft=None):
+    """打开照片，src 可以是路径或文件对象
+
+    draft 为 (宽, 高) 时允许缩小解码：JPEG 按 1/2~1/8 解码，HEIC 用内嵌的够大的缩略图。
+    HEIC/HEIF 要完整解码时先查解码缓存，没有就解码一次存进去（需要 content_hash，预览用）；
+    返回的 HEIC 图片已经载入。不给 content_hash 时只读文件头，不碰缓存。
+    HEIC 的像素方向由 libheif 转正，EXIF 方向为1。
+    """
+    if content_hash:
+        cached = _decode_cache_get(content_hash)
+        if cached is not None:
+            return cached
+    try:
+        img = Image.open(src)
+    except Image.UnidentifiedImageError:
+        if pillow_heif is None and _is_heif(src):
+            raise ValueError('HEIC/HEIF 需要安装 pillow-heif: pip install pillow-heif') from None
+        raise ValueError('无法识别的图片格式') from None
+    if draft is not None and img.draft('RGB', draft) is not None:
+        return img
+    if img.format == 'HEIF' and content_hash:
+        return _decode_cache_put(content_hash, img)
+    return img
+
+def _is_heif(src):
+    if isinstance(src, (str, Path)):
+        with open(src, 'rb') as f:
+            head = f.read(12)
+    else:
+        pos = src.tell()
+        src.seek(0)
+        head = src.read(12)
+        src.seek(pos)
+    return head[4:8] == b'ftyp' and head[8:12] in HEIF_BRANDS
+
+def _decode_cache_get(content_hash):
+    ppm = DECODE_CACHE_DIR / f'{content_hash}.ppm'
+    try:
+        img = Image.open(ppm)
+        img.load()
+        meta = json.loads(ppm.with_suffix('.json').read_text())
+    except (OSError, ValueError):
+        return None
+    for k, v in meta.items():
+        img.info[k] = base64.b64decode(v)
+    return img
+
+def _decode_cache_put(content_hash, img):
+    """完整解码并写入缓存；EXIF / ICC 存在旁边的 json 里"""
+    global _decode_cache_writes
+    meta = {k: base64.b64encode(img.info[k]).decode() for k in ('exif', 'icc_profile') if img.info.get(k)}
+    info = {k: img.info[k] for k in ('exif', 'icc_profile') if img.info.get(k)}
+    img = img.convert('RGB')
+    img.info.update(info)
+
+    DECODE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    ppm = DECODE_CACHE_DIR / f'{content_hash}.ppm'
+    tag = uuid.uuid4().hex[:6]
+    for path, write in ((ppm.with_suffix('.json'), lambda f: f.write_text(json.dumps(meta))),
+                        (ppm, lambda f: img.save(f, 'PPM'))):
+        tmp = path.with_name(f'.{path.name}.{tag}')
+        write(tmp)
+        os.replace(tmp, path)
+
+    _decode_cache_writes += 1
+    if _decode_cache_writes % 20 == 0:
+        files = sorted(DECODE_CACHE_DIR.glob('*.ppm'), key=lambda f: f.stat().st_atime, reverse=True)
+        total = 0
+        for f in files:
+            total += f.stat().st_size
+            if total > DECODE_CACHE_MAX_MB * 1024 * 1024:
+                f.unlink(missing_ok=True)
+                f.with_suffix('.json').unlink(missing_ok=True)
+    return img
+
+def make_proxy(src, max_edge, content_hash=None):
+    """生成长边不超过 max_edge 的JPEG小图
+
+    JPEG 用 draft 模式解码，解码器直接按 1/2、1/4、1/8 缩小，比完整解码快得多；
+    HEIC 有够大的内嵌缩略图时直接用，没有时完整解码并放进解码缓存，导出时不用再解一次。
+    """
+    img = open_photo(src, content_hash, draft=(max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=82)
+    return buf.getvalue()
+
+def display_size(src):
+    """原图在显示方向下的宽高，只读文件头"""
+    with Image.open(src) as img:
+        return (img.height, img.width) if exif_orientation(img) in (5, 6, 7, 8) else img.size
+
+_proxy_writes = 0
+
+def get_proxy(src, content_hash, max_edge):
+    """按 (内容hash, 尺寸) 从磁盘缓存取小图，没有就生成"""
+    global _proxy_writes
+    cache_file = PROXY_CACHE_DIR / f'{content_hash}_{max_edge}.jpg'
+    if cache_file.exists():
+        return cache_file
+
+    data = make_proxy(src, max_edge, content_hash)
+    PROXY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_name(f'{cache_file.name}.{uuid.uuid4().hex[:6]}.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, cache_file)
+
+    _proxy_writes += 1
+    if _proxy_writes % 100 == 0:
+        files = sorted(PROXY_CACHE_DIR.glob('*.jpg'), key=lambda f: f.stat().st_atime)
+        for f in files[:max(0, len(files) - PROXY_CACHE_MAX_FILES)]:
+            f.unlink(missing_ok=True)
+    return cache_file
+
+@app.route('/proxy', methods=['GET', 'POST'])
+def proxy():
+    """缩略图/预览小图：GET 按路径读源文件夹里的原图，POST 直接传文件内容"""
+    try:
+        max_edge = min(max(int(request.args.get('size', 160)), 32), 4096)
+        if request.method == 'POST':
+            data = request.get_data()
+            src, content_hash = io.BytesIO(data), hashlib.sha1(data).hexdigest()
+        else:
+            src = resolve_source(request.args.get('dir', ''), request.args.get('name', ''))
+            if src is None:
+                return jsonify({'error': '文件不存在'}), 404
+            content_hash = file_hash(src)
+        resp = send_file(get_proxy(src, content_hash, max_edge), mimetype='image/jpeg')
+        resp.headers['Cache-Control'] = 'private, max-age=86400'
+        # 小图缩放后宽高比有误差，页面按原图尺寸匹配预设
+        if request.method == 'POST':
+            src.seek(0)
+        resp.headers['X-Photo-Size'] = '%dx%d' % display_size(src)
+        return resp
+    except Exception as e:
+        print(f"[Proxy] Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/export_paths', methods=['POST'])
+def export_paths():
+    """按路径导出：服务端和浏览器在同一台机器上，直接读原图，不上传也不复制到临时目录"""
+    try:
+        data = request.get_json()
+        source_dir = Path(data.get('source_dir', '')).expanduser()
+        filenames = data.get('filenames') or []
+        if not filenames:
+            return jsonify({'error': '没有照片'})
+        if not source_dir.is_dir():
+            return jsonify({'error': f'源文件夹不存在: {source_dir}'})
+
+        root = source_dir.resolve()
+        photo_paths, missing = [], []
+        for name in filenames:
+            p = resolve_source(root, name)
+            if p is None:
+                missing.append(name)
+            else:
+                photo_paths.append(str(p))
+        if missing:
+            return jsonify({'error': f'{len(missing)} 个文件找不到', 'missing': missing[:20]})
+
+        export_path = resolve_export_path(data.get('export_path', ''))
+        print(f"[Export] Path export from {root}, export_path: {export_path}, count: {len(photo_paths)}")
+        task_id = uuid.uuid4().hex[:10]
+        start_export(task_id, photo_paths, len(photo_paths), export_path,
+                     data.get('watermark', ''), data.get('config') or {}, None)
+        return jsonify({'task_id': task_id})
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        return jsonify({'error': str(e)})
+
+class UploadIngest:
+    """流式解析 multipart 上传
+
+    表单字段（count/export_path/watermark/config）要排在照片前面。
+    收到第一张照片时就建任务启动导出，之后每张照片的分段一收完就放进队列，
+    导出和上传同时进行。
+    """
+
+    def __init__(self, boundary, task_id):
+        self.task_id = task_id
+        self.decoder = MultipartDecoder(boundary)
+        self.fields = {}
+        self.photos = queue.Queue()
+        self.temp_dir = Path('/tmp') / f'wm_{uuid.uuid4().hex[:8]}'
+        self.started = False
+        self.received = 0
+        self._names = set()
+        self._part = None
+        self._buf = None
+        self._file = None
+        self._path = None
+
+    def feed(self, data):
+        """data 为 None 表示请求体已经收完"""
+        self.decoder.receive_data(data)
+        event = self.decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, Field):
+                self._part, self._buf = event, []
+            elif isinstance(event, File):
+                if not self.started:
+                    self._start()
+                self._part = event
+                self._open_photo(Path(event.filename or '').name)
+            elif isinstance(event, Data):
+                if isinstance(self._part, Field):
+                    self._buf.append(event.data)
+                elif self._file:
+                    self._file.write(event.data)
+                if not event.more_data:
+                    self._end_part()
+            event = self.decoder.next_event()
+        if data is None:
+            self.finish()
+
+    def _start(self):
+        count = int(self.fields.get('count', 0))
+        if count == 0:
+            raise ValueError('没有照片')
+        export_path = resolve_export_path(self.fields.get('export_path', ''))
+        print(f"[Export] Streaming export_path: {export_path}, count: {count}")
+        cfg = json.loads(self.fields.get('config', '{}'))
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        start_export(self.task_id, iter(self.photos.get, None), count, export_path,
+                     self.fields.get('watermark', ''), cfg, self.temp_dir)
+        self.started = True
+
+    def _open_photo(self, name):
+        # 任务已经失败（比如水印无效）或被取消时剩下的照片直接丢掉
+        if not name or export_tasks[self.task_id]['status'] in ('error', 'cancelled') or not self.temp_dir.exists():
+            self._file = None
+            return
+        # 收完之前用隐藏的 .part 文件名，重启后恢复任务时不会把写了一半的照片当成待处理
+        self._path = self.temp_dir / name
+        if name in self._names:
+            # 同名照片放到子目录里，输出文件名由 output_path 按上传顺序加 _2、_3 区分
+            self._path = self.temp_dir / str(self.received) / name
+            self._path.parent.mkdir()
+        self._names.add(name)
+        self._file = open(self._path.with_name(f'.{name}.part'), 'wb')
+
+    def _end_part(self):
+        if isinstance(self._part, Field):
+            self.fields[self._part.name] = b''.join(self._buf).decode('utf-8', 'replace')
+        elif self._file:
+            self._file.close()
+            self._file = None
+            os.replace(self._path.with_name(f'.{self._path.name}.part'), self._path)
+            self.received += 1
+            self.photos.put(str(self._path))
+        self._part = None
+
+    def finish(self):
+        if not self.started:
+            raise ValueError('没有照片')
+        if self._file:
+            self._file.close()
+            self._file = None
+        self.photos.put(None)
+
+def stream_task_id(task_id):
+    """前端预先生成的 task_id 格式不对或已被占用时改用新的"""
+    if not re.fullmatch(r'[0-9a-f]{10}', task_id or '') or task_id in export_tasks or task_store.get(task_id):
+        task_id = uuid.uuid4().hex[:10]
+    return task_id
 
-        t = threading.Thread(target=do_export, args=(task_id, photo_paths, export_path, watermark_data, cfg, temp_dir))
-        t.daemon = True
-        t.start()
+@app.route('/export_stream', methods=['POST'])
+def export_stream():
+    """边上传边导出，task_id 可以由前端预先生成，上传过程中就能查询进度"""
+    ingest = None
+    try:
+        ctype, opts = parse_options_header(request.headers.get('Content-Type', ''))
+        if ctype != 'multipart/form-data' or not opts.get('boundary'):
+            return jsonify({'error': '需要 multipart/form-data'})
+
+        task_id = stream_task_id(request.args.get('task_id', ''))
+        ingest = UploadIngest(opts['boundary'].encode(), task_id)
+        while True:
+            data = request.stream.read(64 * 1024) or None
+            ingest.feed(data)
+            if data is None:
+                break
+
+        return jsonify({'task_id': task_id, 'received': ingest.received})
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        if ingest is not None and ingest.started:
+            ingest.finish()
+        return jsonify({'error': str(e)})
 
+class BlobOffsetError(Exception):
+    def __init__(self, received):
+        super().__init__(f'应该从 {received} 开始上传')
+        self.received = received
+
+class BlobStore:
+    """照片按 sha1 存在 BLOB_DIR，分块上传，断了可以从已收到的位置接着传
+
+    上传中的内容写在 .{hash}.part 里，收齐后校验hash再改名。
+    最近一次使用记在文件的修改时间上（查询、导出时更新），不依赖 atime（relatime 下一天才更新一次）；
+    没结束的任务用到的照片记在 _held 里，清理时不删。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._locks = {}
+        self._held = {}
+        self._lock = threading.Lock()
+        self._finished = 0
+
+    def path(self, digest):
+        return self.root / digest
+
+    def exists(self, digest):
+        """存在时顺便记一次使用"""
+        if not re.fullmatch(r'[0-9a-f]{40}', digest or ''):
+            return False
+        try:
+            os.utime(self.path(digest))
+        except OSError:
+            return False
+        return self.path(digest).is_file()
+
+    def hold(self, task_id, digests):
+        with self._lock:
+            self._held[task_id] = set(digests)
+
+    def release(self, task_id):
+        with self._lock:
+            self._held.pop(task_id, None)
+
+    def offset(self, digest):
+        """已经收到的字节数"""
+        if self.exists(digest):
+            return self.path(digest).stat().st_size
+        try:
+            return self._part(digest).stat().st_size
+        except OSError:
+            return 0
+
+    def write(self, digest, offset, total, stream):
+        """从 offset 开始追加一块；offset 和已收到的不一致时抛 BlobOffsetError。返回 (已收到字节数, 是否完成)"""
+        if not re.fullmatch(r'[0-9a-f]{40}', digest or ''):
+            raise ValueError('hash 格式不对')
+        with self._hash_lock(digest):
+            if self.exists(digest):
+                return self.path(digest).stat().st_size, True
+            part = self._part(digest)
+            received = part.stat().st_size if part.exists() else 0
+            if offset != received:
+                raise BlobOffsetError(received)
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(part, 'ab') as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+                received = f.tell()
+            if received < total:
+                return received, False
+
+            h = hashlib.sha1()
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            if h.hexdigest() != digest or received != total:
+                part.unlink(missing_ok=True)
+                self._drop_lock(digest)
+                raise ValueError('内容和 hash 不一致，请重新上传')
+            os.replace(part, self.path(digest))
+            self._drop_lock(digest)
+        self._finished += 1
+        if self._finished % 50 == 0:
+            self.cleanup()
+        return received, True
+
+    def cleanup(self):
+        """超过上限时删最久没用的；任务还在用的、一小时内用过的（刚查询过、马上要导出）不删"""
+        with self._lock:
+            held = set().union(*self._held.values())
+        files = []
+        for f in self.root.iterdir():
+            try:
+                files.append((f, f.stat()))
+            except OSError:
+                pass
+        files.sort(key=lambda item: item[1].st_mtime, reverse=True)
+        total, now = 0, time.time()
+        for f, st in files:
+            if f.name.startswith('.'):
+                continue
+            total += st.st_size
+            if total > BLOB_STORE_MAX_MB * 1024 * 1024 and now - st.st_mtime > 3600 and f.name not in held:
+                f.unlink(missing_ok=True)
+
+    def _part(self, digest):
+        return self.root / f'.{digest}.part'
+
+    def _hash_lock(self, digest):
+        with self._lock:
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def _drop_lock(self, digest):
+        # 上传结束（收齐或校验失败）后不再需要；在持有锁时调用，之后来的请求会看到已经存在
+        with self._lock:
+            self._locks.pop(digest, None)
+
+blobs = BlobStore(BLOB_DIR)
+
+@app.route('/blobs/check', methods=['POST'])
+def blobs_check():
+    """返回还没存过的 hash，只有这些需要上传"""
+    hashes = (request.get_json() or {}).get('hashes') or []
+    return jsonify({'missing': [h for h in hashes if not blobs.exists(h)]})
+
+@app.route('/blobs/<digest>', methods=['GET'])
+def blob_status(digest):
+    """断点续传前查询已经收到多少字节"""
+    return jsonify({'complete': blobs.exists(digest), 'offset': blobs.offset(digest)})
+
+@app.route('/blobs/<digest>', methods=['PUT'])
+def blob_upload(digest):
+    """PUT /blobs/<sha1>?offset=已传字节数&total=总字节数，请求体是这一块的内容"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        total = int(request.args['total'])
+        received, complete = blobs.write(digest, offset, total, request.stream)
+        return jsonify({'offset': received, 'complete': complete})
+    except BlobOffsetError as e:
+        return jsonify({'error': str(e), 'offset': e.received}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/export_blobs', methods=['POST'])
+def export_blobs():
+    """按已上传的照片hash导出：photos 为 [{hash, name}]，其余字段同 /export_paths
+
+    临时目录里只放指向存储的符号链接，用原文件名，导出结束后删掉链接，存储里的照片保留。
+    """
+    try:
+        data = request.get_json()
+        photos = data.get('photos') or []
+        if not photos:
+            return jsonify({'error': '没有照片'})
+        missing = [p.get('hash') for p in photos if not blobs.exists(p.get('hash'))]
+        if missing:
+            return jsonify({'error': f'{len(missing)} 张照片还没上传', 'missing': missing})
+
+        export_path = resolve_export_path(data.get('export_path', ''))
+        temp_dir = Path('/tmp') / f'wm_{uuid.uuid4().hex[:8]}'
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        photo_paths = []
+        for i, p in enumerate(photos):
+            name = Path(p.get('name') or p['hash']).name
+            link = temp_dir / name
+            if link.exists() or link.is_symlink():
+                # 同名照片放到子目录里，输出文件名由 output_path 加 _2、_3 区分
+                link = temp_dir / str(i) / name
+                link.parent.mkdir()
+            link.symlink_to(blobs.path(p['hash']))
+            photo_paths.append(str(link))
+
+        task_id = stream_task_id(data.get('task_id', ''))
+        blobs.hold(task_id, [p['hash'] for p in photos])
+        print(f"[Export] Blob export_path: {export_path}, count: {len(photo_paths)}")
+        start_export(task_id, photo_paths, len(photo_paths), export_path,
+                     data.get('watermark', ''), data.get('config') or {}, temp_dir)
         return jsonify({'task_id': task_id})
     except Exception as e:
         import traceback; traceback.print_exc()
         return jsonify({'error': str(e)})
 
-def do_export(task_id, photo_paths, export_path, watermark_data, cfg, temp_dir):
+def get_export_pool():
+    """所有导出任务共用一个进程池，首次导出时创建
+
+    导出线程是在Flask的请求线程里起的，多线程下fork容易死锁，统一用spawn。
+    工作进程只做解码和合成，编码在进程内单独的编码线程里做，
+    结果通过 _result_queue 送回主进程，见 submit_photo。
+    有工作进程异常退出（被 OOM 杀掉、解码器崩溃）后整个池子不能再用，这时换一个新的，
+    旧池子里已经开始处理的照片由它自己的结果线程标记失败，还没开始的重新提交到新池子，之后的任务不受影响。
+    """
+    global _export_pool, _result_queue
+    with _export_pool_lock:
+        if _export_pool is not None and getattr(_export_pool, '_broken', False):
+            print("[Export] Process pool broken, restarting")
+            _export_pool.shutdown(wait=False, cancel_futures=True)
+            _export_pool = None
+        if _export_pool is None:
+            ctx = multiprocessing.get_context('spawn')
+            _result_queue = ctx.Queue()
+            _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=ctx,
+                                               initializer=_init_worker,
+                                               initargs=(_result_queue, WATERMARK_DIR, DECODE_CACHE_DIR))
+            t = threading.Thread(target=_collect_results, args=(_export_pool, _result_queue), name='export-results')
+            t.daemon = True
+            t.start()
+            print(f"[Export] Process pool started: {EXPORT_WORKERS} workers")
+        return _export_pool
+
+_result_queue = None
+_photo_futures = {}
+_photo_keys = itertools.count()
+
+class PhotoFuture(Future):
+    """单张照片的结果；编码完成（或跳过、出错）后才有结果
+
+    取消时把进程池里还没开始的那一步也取消掉。
+    started 表示工作进程已经开始处理，进程池坏掉时没开始的照片换新池子重新提交。
+    """
+
+    def __init__(self, key, args):
+        super().__init__()
+        self.key = key
+        self.args = args
+        self.pool = None
+        self.pool_future = None
+        self.started = False
+        self.retries = 0
+
+    def cancel(self):
+        if self.pool_future is not None and not self.pool_future.cancel():
+            return False
+        _photo_futures.pop(self.key, None)
+        return super().cancel()
+
+def submit_photo(*args):
+    """提交一张照片，参数同 export_photo，返回 PhotoFuture"""
+    fut = PhotoFuture(next(_photo_keys), args)
+    _photo_futures[fut.key] = fut
+    _submit_to_pool(fut)
+    return fut
+
+def _submit_to_pool(fut):
+    try:
+        fut.pool = get_export_pool()
+        fut.pool_future = fut.pool.submit(export_photo, *fut.args, key=fut.key)
+    except BrokenProcessPool:
+        # 提交前刚好有工作进程退出，换新池子再提交一次
+        fut.pool = get_export_pool()
+        fut.pool_future = fut.pool.submit(export_photo, *fut.args, key=fut.key)
+    fut.pool_future.add_done_callback(lambda pf: _on_decoded(fut, pf))
+
+class MemoryBudget:
+    """按解码后的估算内存放行照片，预算用完时后面的照片等前面的处理完再提交
+
+    单张就超过预算的照片在没有其他照片处理时也放行，不会卡死。
+    """
+
+    def __init__(self, limit_mb):
+        self.limit = limit_mb * 1024 * 1024
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, timeout=None):
+        with self._cond:
+            if self.limit and not self._cond.wait_for(
+                    lambda: not self.used or self.used + nbytes <= self.limit, timeout):
+                return False
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_MB)
+
+def decode_size(img, max_edge):
+    """实际会解码出的尺寸：设了最长边时 JPEG 按 1/2、1/4、1/8 缩小解码（和 Pillow draft 的选法一致）"""
+    w, h = img.size
+    if not max_edge or max(w, h) <= max_edge or img.format != 'JPEG':
+        return w, h
+    tw, th = draft_target(w, h, max_edge)
+    scale = min(w // tw, h // th)
+    for s in (8, 4, 2, 1):
+        if scale >= s:
+            break
+    return (w + s - 1) // s, (h + s - 1) // s
+
+def draft_target(w, h, max_edge):
+    scale = max_edge / max(w, h)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+def estimate_memory(p, opts):
+    """只读文件头估算处理一张照片的峰值内存：原文件 + 解码帧 + 转RGB + 缩小后的帧"""
+    size = os.path.getsize(p)
+    try:
+        with Image.open(p) as img:
+            w, h = decode_size(img, opts['max_edge'])
+            mode = img.mode
+    except Exception:
+        # 打不开的交给工作进程去报错
+        return size
+    frame = w * h * Image.getmodebands(mode)
+    if mode != 'RGB':
+        frame += w * h * 3
+    max_edge = opts['max_edge']
+    if max_edge and max(w, h) > max_edge:
+        tw, th = draft_target(w, h, max_edge)
+        frame += tw * th * 3
+    return size + frame
+
+def _resolve_photo(key, result=None, error=None):
+    fut = _photo_futures.pop(key, None)
+    if fut is None or fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+def _on_decoded(fut, pool_future):
+    if pool_future.cancelled():
+        return
+    error = pool_future.exception()
+    if isinstance(error, BrokenProcessPool):
+        # 进程池坏了，由这个池子的结果线程决定标记失败还是重新提交
+        return
+    if error is not None:
+        _resolve_photo(fut.key, error=error)
+    elif pool_future.result() is not None:
+        # 跳过的照片没有编码这一步，直接有结果
+        _resolve_photo(fut.key, pool_future.result())
+
+# 工作进程开始处理一张照片时先送回这个标记
+_PHOTO_STARTED = 'started'
+
+def _collect_results(pool, result_queue):
+    """主进程里接收各工作进程编码线程送回的结果，每个进程池一个"""
+    while True:
+        try:
+            key, result, error = result_queue.get(timeout=1)
+        except queue.Empty:
+            # 工作进程异常退出时，这个池子里已经开始处理的照片不会再有结果，标记失败；
+            # 还没开始的换新池子重新提交（最多一次，防止开始消息没送回来时反复崩），这个线程退出
+            if getattr(pool, '_broken', False):
+                for key, fut in list(_photo_futures.items()):
+                    if fut.pool is not pool:
+                        continue
+                    if fut.started or fut.retries:
+                        _resolve_photo(key, error=BrokenProcessPool('导出进程异常退出'))
+                    else:
+                        fut.retries += 1
+                        _submit_to_pool(fut)
+                return
+            continue
+        if result == _PHOTO_STARTED:
+            fut = _photo_futures.get(key)
+            if fut is not None:
+                fut.started = True
+            continue
+        _resolve_photo(key, result, error)
+
+# 工作进程里的编码线程和它的输入队列；队列长度1，最多一张在等编码，控制内存
+_encode_queue = None
+_worker_results = None
+
+def _init_worker(result_queue, watermark_dir, decode_cache_dir):
+    global _encode_queue, _worker_results, WATERMARK_DIR, DECODE_CACHE_DIR
+    _worker_results = result_queue
+    # spawn 出来的进程重新导入模块，目录跟主进程走（bench.py 会改到临时目录）
+    WATERMARK_DIR, DECODE_CACHE_DIR = watermark_dir, decode_cache_dir
+    _encode_queue = queue.Queue(maxsize=1)
+    t = threading.Thread(target=_encode_loop, name='encoder')
+    t.daemon = True
+    t.start()
+
+def _encode_loop():
+    """编码线程：编码保存和下一张照片的解码同时进行（Pillow编码时会释放GIL）"""
+    while True:
+        key, img, out_file, fmt, opts, meta, result, start, queued = _encode_queue.get()
+        _lap(result['stages'], 'queue_wait', queued)
+        try:
+            result['bytes_out'] = encode_image(img, out_file, fmt, opts, meta, result['stages'])
+            result['seconds'] = time.perf_counter() - start
+            _worker_results.put((key, result, None))
+        except Exception as e:
+            _worker_results.put((key, None, e))
+
+# 工作进程内缓存解码后的水印，同一任务的照片不用重复解析PNG
+_worker_watermarks = {}
+
+def _get_watermark(wm_key, wm_bytes=None):
+    """wm_bytes 为 None 时按 hash 从水印登记目录读"""
+    wm = _worker_watermarks.get(wm_key)
+    if wm is None:
+        if len(_worker_watermarks) >= 4:
+            _worker_watermarks.pop(next(iter(_worker_watermarks)))
+        src = io.BytesIO(wm_bytes) if wm_bytes is not None else watermark_file(wm_key)
+        wm = Image.open(src).convert('RGBA')
+        _worker_watermarks[wm_key] = wm
+    return wm
+
+class NumpyTile:
+    """numpy 后端用的水印，透明度在缓存时就乘进去
+
+    premul = rgb * alpha + 128，inv = 255 - alpha，都是 uint16，
+    混合时每个像素只剩一次乘法和加法。
+    """
+
+    def __init__(self, wm_r, opacity):
+        arr = np.asarray(wm_r)
+        # 和 pillow 的 int(x * op) 一样向下取整
+        alpha = (arr[..., 3:] * np.float32(opacity)).astype(np.uint16)
+        self.premul = arr[..., :3] * alpha + 128
+        self.inv = 255 - alpha
+        self.width, self.height = wm_r.size
+
+def blend_numpy(region, tile, ox, oy):
+    """把 tile 从 (ox, oy) 开始、和 region 一样大的部分 alpha 混合到 region 上
+
+    v = dst * (255 - a) + src * a + 128，再用 (v + (v >> 8)) >> 8 近似除以255，
+    最大值 65407 不会溢出 uint16。
+    """
+    h, w = region.height, region.width
+    v = np.asarray(region) * tile.inv[oy:oy + h, ox:ox + w]
+    v += tile.premul[oy:oy + h, ox:ox + w]
+    v += v >> 8
+    v >>= 8
+    return Image.fromarray(v.astype(np.uint8), 'RGB')
+
+# EXIF 方向 2~8 时，把显示方向的水印转回照片存储方向用的 transpose
+_EXIF_TO_STORED = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180, 4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE, 6: Image.Transpose.ROTATE_90, 7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_270,
+}
+
+def exif_orientation(img):
+    try:
+        orientation = img.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in _EXIF_TO_STORED else 1
+
+def map_to_stored(orientation, x, y, w, h, sw, sh):
+    """显示方向下左上角在 (x, y)、大小 w*h 的框，在存储像素（sw*sh）里的左上角"""
+    if orientation == 2:
+        return sw - x - w, y
+    if orientation == 3:
+        return sw - x - w, sh - y - h
+    if orientation == 4:
+        return x, sh - y - h
+    if orientation == 5:
+        return y, x
+    if orientation == 6:
+        return y, sh - x - w
+    if orientation == 7:
+        return sw - y - h, sh - x - w
+    if orientation == 8:
+        return sw - y - h, x
+    return x, y
+
+def prepare_watermark(wm, size, opacity, backend=None, orientation=1):
+    """缩放水印并应用透明度；orientation 不为1时再转成照片存储方向"""
+    return _finish_watermark(wm.resize(size, Image.Resampling.LANCZOS), opacity, backend, orientation)
+
+class TiledWatermark:
+    """平铺水印：旋转、缩放、透明度都处理好的一个水印，加上每一格在照片存储方向里的左上角"""
+
+    def __init__(self, tile, positions):
+        self.tile = tile
+        self.positions = positions
+
+def prepare_tiled_watermark(wm, size, opacity, tile, backend=None, orientation=1):
+    """tile 为 (显示宽, 显示高, 间距, 角度)
+
+    以照片中心为原点排网格，格距为水印宽高加上 间距% * 水印宽，整个网格逆时针旋转 角度 度，
+    每个格点放一个同样旋转过的水印。水印只旋转一次，位置也只算一次，同尺寸同设置的照片共用。
+    逐格混合只碰水印覆盖的地方，间距里的空白不用处理；但间距小、旋转后外框重叠多时，
+    逐格要混合的面积会超过整张照片，这时先拼成一整层，每张照片只混合一次。
+    前端 drawTiled 用同样的排法预览。
+    """
+    dw, dh, spacing, angle = tile
+    wm_r = wm.resize(size, Image.Resampling.LANCZOS)
+    gap = int(size[0] * max(spacing, 0) / 100)
+    step_x, step_y = size[0] + gap, size[1] + gap
+    if angle % 360:
+        # 预乘alpha后再旋转，透明边缘不会发黑
+        wm_r = wm_r.convert('RGBa').rotate(angle, Image.Resampling.BICUBIC, expand=True).convert('RGBA')
+    tw, th = wm_r.size
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    n = int(math.hypot(dw, dh) / 2 / min(step_x, step_y)) + 2
+    positions, area = [], 0
+    for j in range(-n, n + 1):
+        for i in range(-n, n + 1):
+            u, v = i * step_x, j * step_y
+            # y 轴向下，逆时针旋转后的格点
+            x = round(dw / 2 + u * cos + v * sin - tw / 2)
+            y = round(dh / 2 - u * sin + v * cos - th / 2)
+            if -tw < x < dw and -th < y < dh:
+                positions.append((x, y))
+                area += (min(x + tw, dw) - max(x, 0)) * (min(y + th, dh) - max(y, 0))
+
+    if area > dw * dh:
+        # 四周留出一个水印的边，贴在边上的不用单独裁；相邻水印外框重叠，用 alpha_composite 不会被透明角盖掉
+        layer = Image.new('RGBA', (dw + 2 * tw, dh + 2 * th))
+        for x, y in positions:
+            layer.alpha_composite(wm_r, (x + tw, y + th))
+        layer = layer.crop((tw, th, tw + dw, th + dh))
+        return TiledWatermark(_finish_watermark(layer, opacity, backend, orientation), [(0, 0)])
+    sw, sh = (dh, dw) if orientation in (5, 6, 7, 8) else (dw, dh)
+    return TiledWatermark(_finish_watermark(wm_r, opacity, backend, orientation),
+                          [map_to_stored(orientation, x, y, tw, th, sw, sh) for x, y in positions])
+
+def _finish_watermark(wm_r, opacity, backend=None, orientation=1):
+    if orientation in _EXIF_TO_STORED:
+        wm_r = wm_r.transpose(_EXIF_TO_STORED[orientation])
+    if (backend or BLEND_BACKEND) == 'numpy':
+        return NumpyTile(wm_r, opacity)
+    if opacity < 1:
+        a = wm_r.split()[3].point(lambda x: int(x * opacity))
+        wm_r.putalpha(a)
+    return wm_r
+
+class WatermarkCache:
+    """处理好的水印LRU缓存，键为 (水印hash, 宽, 高, 透明度, EXIF方向, 平铺参数)
+
+    同一相机拍出的照片尺寸基本一致，命中后就不用再做LANCZOS缩放和透明度处理；
+    平铺时还省掉旋转和排位置。
+    缓存里的图片是共享的，调用方不能修改。
+    份数和占用内存都有上限，超出时淘汰最久没用的；刚放进去的那份总是保留。
+    """
+
+    def __init__(self, maxsize=WATERMARK_CACHE_SIZE, max_mb=WATERMARK_CACHE_MAX_MB):
+        self.maxsize = maxsize
+        self.max_bytes = max_mb * 1024 * 1024
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, wm_key, wm, size, opacity, orientation=1, tile=None):
+        """返回 (水印图片, 是否命中)；tile 见 prepare_tiled_watermark，为 None 时是单个水印"""
+        key = (wm_key, size[0], size[1], opacity, orientation, tile)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item, True
+            self.misses += 1
+
+        if tile is None:
+            item = prepare_watermark(wm, size, opacity, orientation=orientation)
+        else:
+            item = prepare_tiled_watermark(wm, size, opacity, tile, orientation=orientation)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = item
+                self.nbytes += _watermark_nbytes(item)
+            while len(self._items) > 1 and (len(self._items) > self.maxsize or self.nbytes > self.max_bytes):
+                self.nbytes -= _watermark_nbytes(self._items.popitem(last=False)[1])
+        return item, False
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'bytes': self.nbytes}
+
+def _watermark_nbytes(item):
+    if isinstance(item, TiledWatermark):
+        item = item.tile
+    if isinstance(item, NumpyTile):
+        return item.premul.nbytes + item.inv.nbytes
+    return item.width * item.height * len(item.getbands())
+
+_worker_wm_cache = WatermarkCache()
+
+def composite_watermark(img, wm, x, y):
+    """只在水印覆盖的区域内混合
+
+    x/y 可以超出图片边界（-20%~120% 的位置），超出的部分先从水印上裁掉，
+    整张图不做额外转换。平铺水印逐格这样合成，x/y 是整体偏移。
+    """
+    if isinstance(wm, TiledWatermark):
+        for px, py in wm.positions:
+            composite_watermark(img, wm.tile, x + px, y + py)
+        return img
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + wm.width, img.width), min(y + wm.height, img.height)
+    if right <= left or bottom <= top:
+        return img
+
+    if isinstance(wm, NumpyTile):
+        region = blend_numpy(img.crop((left, top, right, bottom)), wm, left - x, top - y)
+        img.paste(region, (left, top))
+    else:
+        # 带 mask 直接贴到原图上，和先裁出区域再贴回去结果一样，少两次整块拷贝
+        tile = wm if (left - x, top - y, right - x, bottom - y) == (0, 0) + wm.size else \
+            wm.crop((left - x, top - y, right - x, bottom - y))
+        img.paste(tile, (left, top), tile)
+    return img
+
+class ExportManifest:
+    """导出目录里的 .wm_manifest.json
+
+    记录每个输出文件对应的源文件hash、水印hash和实际生效的设置，
+    重新导出时三者都没变且输出文件还在的照片直接跳过。
+    多个任务可能同时导出到同一个目录，保存时先读出最新内容再合并。
+    """
+
+    FILE_NAME = '.wm_manifest.json'
+    _lock = threading.Lock()
+
+    def __init__(self, out_dir):
+        self.path = Path(out_dir) / self.FILE_NAME
+        self.entries = self._read()
+        self.updates = {}
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, out_name):
+        return self.entries.get(out_name)
+
+    def put(self, out_name, entry):
+        self.entries[out_name] = entry
+        self.updates[out_name] = entry
+
+    def save(self):
+        if not self.updates:
+            return
+        with self._lock:
+            merged = self._read()
+            merged.update(self.updates)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(merged, f, indent=1, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        self.updates = {}
+
+def output_path(out_dir, p, used, ext=None):
+    """输出文件名固定为 wm_{原文件名}，重新导出时直接覆盖
+
+    used 记录本批已经分配的文件名，不同子文件夹里的同名照片依次加 _2、_3 区分。
+    ext 为输出格式的扩展名，不传则沿用原文件的。
+    """
+    base_name = Path(p).stem
+    ext = ext or Path(p).suffix or '.jpg'
+    name = f'wm_{base_name}{ext}'
+    n = 1
+    while name in used:
+        n += 1
+        name = f'wm_{base_name}_{n}{ext}'
+    used.add(name)
+    return Path(out_dir) / name
+
+TILE_DEFAULTS = {'spacing': 50, 'angle': 30}
+
+def _settings(s, base=None):
+    """x/y/size/opacity，缺省项从 base 或默认值补上
+
+    mode 为 tile（平铺）时再带上 spacing/angle；单个水印不带这几项，和以前的清单记录一致。
+    """
+    base = base or {'x': 95, 'y': 95, 'size': 15, 'opacity': 80}
+    out = {k: s.get(k, base[k]) for k in ('x', 'y', 'size', 'opacity')}
+    if s.get('mode', base.get('mode')) == 'tile':
+        out['mode'] = 'tile'
+        for k, v in TILE_DEFAULTS.items():
+            out[k] = s.get(k, base.get(k, v))
+    return out
+
+class PresetTable:
+    """按宽高比（显示方向的宽/高）查预设
+
+    config 里的 presets 是列表，每项有 name、min_ratio、max_ratio（左闭右开，缺省不限）、
+    x/y/size/opacity，可选 watermark（水印hash）。重叠时排在前面的优先，都不匹配时按横竖图用
+    landscape / portrait。
+    建表时把所有边界排好序，算出每一段落在哪个预设里，查找只要一次二分；
+    同样尺寸的照片再查直接命中缓存。
+    """
+
+    def __init__(self, cfg):
+        self.fallback = {'landscape': _settings(cfg.get('landscape', {})),
+                         'portrait': _settings(cfg.get('portrait', cfg.get('landscape', {})))}
+        presets = []
+        for i, p in enumerate(cfg.get('presets') or []):
+            lo = float(p.get('min_ratio') or 0)
+            hi = float(p['max_ratio']) if p.get('max_ratio') is not None else float('inf')
+            presets.append((lo, hi, p.get('name') or f'preset{i + 1}', _settings(p), p.get('watermark')))
+        self.by_name = {name: (s, wm) for _, _, name, s, wm in presets}
+
+        self._bounds = sorted({b for lo, hi, *_ in presets for b in (lo, hi) if 0 < b < float('inf')})
+        edges = [0.0] + self._bounds + [float('inf')]
+        self._segments = []
+        for seg_lo, seg_hi in zip(edges, edges[1:]):
+            hit = next((p for p in presets if p[0] <= seg_lo and seg_hi <= p[1]), None)
+            self._segments.append(hit and (hit[2], hit[3], hit[4]))
+        self._memo = {}
+
+    def lookup(self, width, height):
+        """返回 (预设名, 设置, 水印hash)，没有匹配的预设时预设名和水印为 None"""
+        key = (width, height)
+        hit = self._memo.get(key)
+        if hit is None:
+            hit = self._segments[bisect.bisect_right(self._bounds, width / height)]
+            if hit is None:
+                hit = (None, self.fallback['landscape' if width > height else 'portrait'], None)
+            self._memo[key] = hit
+        return hit
+
+    def resolve(self, width, height, override=None):
+        """override 是单张照片的覆盖：preset 指定用哪个预设，x/y/size/opacity/watermark 覆盖对应项"""
+        name, s, wm = self.lookup(width, height)
+        if override:
+            if override.get('preset') in self.by_name:
+                name = override['preset']
+                s, wm = self.by_name[name]
+            s = _settings(override, s)
+            wm = override.get('watermark') or wm
+        return name, s, wm
+
+_preset_tables = OrderedDict()
+
+def preset_table(cfg):
+    """同一份设置只建一次表；工作进程里每张照片都会调用，按内容缓存"""
+    key = json.dumps([cfg.get('presets'), cfg.get('landscape'), cfg.get('portrait')], sort_keys=True)
+    table = _preset_tables.get(key)
+    if table is None:
+        table = _preset_tables[key] = PresetTable(cfg)
+        while len(_preset_tables) > 8:
+            _preset_tables.popitem(last=False)
+    return table
+
+def resolve_settings(cfg, width, height, override=None):
+    """按预设 / 横竖图取出生效的设置，缺省项补默认值"""
+    return preset_table(cfg).resolve(width, height, override)[1]
+
+def split_overrides(cfg):
+    """把单张照片的覆盖从配置里拿出来，按文件名单独传给每张照片，不用每张都带上整个表"""
+    overrides = cfg.get('overrides') or {}
+    return {k: v for k, v in cfg.items() if k != 'overrides'}, overrides
+
+def resolve_output(cfg):
+    """取出输出设置并检查格式是否可用"""
+    opts = dict(default_output, **(cfg.get('output') or {}))
+    fmt = opts['format']
+    if fmt != 'original':
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f'不支持的输出格式: {fmt}')
+        Image.init()
+        if OUTPUT_FORMATS[fmt][0] not in Image.SAVE:
+            raise ValueError(f'当前 Pillow 不支持写出 {fmt.upper()}')
+    opts['quality'] = int(opts['quality'])
+    opts['max_edge'] = int(opts['max_edge'] or 0)
+    return opts
+
+def output_format(p, opts):
+    """返回 (Pillow格式名, 扩展名)；原格式写不出来的（如HEIC）转成JPEG"""
+    if opts['format'] != 'original':
+        return OUTPUT_FORMATS[opts['format']]
+    ext = Path(p).suffix
+    if ext.lower() in ('.jpg', '.jpeg'):
+        return 'JPEG', ext
+    if ext.lower() == '.png':
+        return 'PNG', ext
+    return 'JPEG', '.jpg'
+
+def encode_params(fmt, opts, meta=None):
+    """输出设置换成 Image.save 的参数；meta 里的 icc_profile / exif 原样带上"""
+    params = {}
+    if fmt == 'JPEG':
+        params = {'quality': opts['quality'], 'progressive': opts['progressive'], 'optimize': opts['optimize']}
+        if opts['subsampling'] != 'auto':
+            params['subsampling'] = opts['subsampling']
+    elif fmt == 'WEBP':
+        params = {'quality': opts['quality'], 'method': 4}
+    elif fmt == 'AVIF':
+        params = {'quality': opts['quality']}
+        if opts['subsampling'] != 'auto':
+            params['subsampling'] = opts['subsampling']
+    elif fmt == 'PNG':
+        params = {'optimize': opts['optimize']}
+    for k, v in (meta or {}).items():
+        if v:
+            params[k] = v
+    return params
+
+def encode_image(img, out_file, fmt, opts, meta=None, stages=None):
+    """按输出设置编码保存，先写临时文件再改名，不会留下写了一半的文件；返回写出的字节数
+
+    传了 stages 时先编码到内存，编码和写盘分开计时。
+    """
+    out_file = Path(out_file)
+    tmp = out_file.with_name(f'.{out_file.name}.part')
+    params = encode_params(fmt, opts, meta)
+    if stages is None:
+        img.save(str(tmp), fmt, **params)
+        os.replace(tmp, out_file)
+        return out_file.stat().st_size
+    t = time.perf_counter()
+    buf = io.BytesIO()
+    img.save(buf, fmt, **params)
+    t = _lap(stages, 'encode', t)
+    tmp.write_bytes(buf.getbuffer())
+    os.replace(tmp, out_file)
+    _lap(stages, 'write', t)
+    return buf.tell()
+
+def _lap(stages, name, t):
+    """把从 t 到现在的耗时累加到 stages[name]，返回现在的时间；stages 为 None（关闭统计）时只取时间"""
+    now = time.perf_counter()
+    if stages is not None:
+        stages[name] = stages.get(name, 0) + now - t
+    return now
+
+def export_photo(p, out_file, wm_key, wm_bytes, cfg, prev=None, override=None, key=None):
+    """在工作进程中处理单张照片：解码 -> (缩小) -> 合成水印 -> 编码保存
+
+    prev 是清单里这个输出文件上次的记录，输入没变就跳过不处理。
+    override 是这张照片单独的设置；匹配的预设或 override 指定了水印时改用那个水印。
+    在进程池里运行时（有编码线程）编码交给编码线程，返回 None，结果随后由编码线程送回；
+    直接调用时在当前线程编码并返回结果。
+    """
+    if key is not None and _worker_results is not None:
+        _worker_results.put((key, _PHOTO_STARTED, None))
+    start = t = time.perf_counter()
+    stages = {} if METRICS_ENABLED else None
+    opts = resolve_output(cfg)
+    data = Path(p).read_bytes()
+    src_hash = hashlib.sha1(data).hexdigest()
+    # 只读文件头，没变化跳过的照片不解码
+    img = open_photo(io.BytesIO(data))
+
+    # 横竖图按显示方向判断；像素不旋转，水印框换算到存储方向里合成
+    orientation = exif_orientation(img)
+    dw, dh = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+    preset, s, preset_wm = preset_table(cfg).resolve(dw, dh, override)
+    if preset_wm and preset_wm != wm_key:
+        wm_key, wm_bytes = preset_wm, None
+    entry = {'source': Path(p).name, 'src_hash': src_hash,
+             'wm_hash': wm_key, 'settings': s, 'output': opts, 'orientation': orientation}
+    if preset:
+        entry['preset'] = preset
+    if prev == entry and Path(out_file).exists():
+        return {'out_file': str(out_file), 'entry': entry, 'skipped': True, 'wm_cache_hit': None,
+                'stages': None, 'bytes_in': len(data), 'bytes_out': 0, 'seconds': time.perf_counter() - start}
+
+    wm = _get_watermark(wm_key, wm_bytes)
+
+    # HEIC 预览时完整解码过的直接用解码缓存；导出不往缓存里写，免得每张都多写一份原尺寸的PPM
+    if img.format == 'HEIF':
+        cached = _decode_cache_get(src_hash)
+        if cached is not None:
+            img = cached
+
+    # ICC 只在原图本来就是RGB时保留；EXIF 原样保留（包括方向）
+    meta = {'exif': img.info.get('exif'),
+            'icc_profile': img.info.get('icc_profile') if img.mode in ('RGB', 'RGBA') else None}
+
+    # 设了最长边时 JPEG 直接缩小解码，大图不用先解出整张
+    max_edge = opts['max_edge']
+    if max_edge and img.format == 'JPEG' and max(img.size) > max_edge:
+        img.draft('RGB', draft_target(img.width, img.height, max_edge))
+        dw, dh = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+
+    # 直接解码成RGB，不再整张转RGBA再转回来
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    else:
+        img.load()
+    t = _lap(stages, 'decode', t)
+
+    # 先缩小再合成，水印只缩放一次，合成和编码的像素也少
+    if max_edge and max(img.size) > max_edge:
+        scale = max_edge / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                         Image.Resampling.LANCZOS, reducing_gap=3.0)
+        dw, dh = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+        t = _lap(stages, 'resize', t)
+
+    sz = s['size'] / 100
+    op = s['opacity'] / 100
+    xp = s['x'] / 100
+    yp = s['y'] / 100
+
+    wm_w = max(1, int(dw * sz))
+    wm_h = max(1, int(wm_w * wm.height / wm.width))
+    if s.get('mode') == 'tile':
+        # 平铺铺满整张照片，x/y 不起作用
+        tile = (dw, dh, s['spacing'], s['angle'])
+        wm_r, cache_hit = _worker_wm_cache.get(wm_key, wm, (wm_w, wm_h), op, orientation, tile)
+        x = y = 0
+    else:
+        wm_r, cache_hit = _worker_wm_cache.get(wm_key, wm, (wm_w, wm_h), op, orientation)
+        x = int((dw - wm_w) * xp)
+        y = int((dh - wm_h) * yp)
+        x, y = map_to_stored(orientation, x, y, wm_w, wm_h, img.width, img.height)
+    t = _lap(stages, 'watermark', t)
+
+    composite_watermark(img, wm_r, x, y)
+    t = _lap(stages, 'composite', t)
+
+    fmt = output_format(p, opts)[0]
+    result = {'out_file': str(out_file), 'entry': entry, 'skipped': False, 'wm_cache_hit': cache_hit,
+              'stages': stages, 'bytes_in': len(data)}
+    if key is not None and _encode_queue is not None:
+        # 编码线程还在忙上一张时这里会等，等的时间由编码线程记为 queue_wait
+        _encode_queue.put((key, img, out_file, fmt, opts, meta, result, start, t))
+        return None
+    result['bytes_out'] = encode_image(img, out_file, fmt, opts, meta, stages)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+class ExportMetrics:
+    """导出统计：照片数、读写字节数、各步骤累计耗时（秒）
+
+    全局一份给 /metrics；每个任务另有一份放在 task['metrics']，/task_status 里能看到。
+    """
+
+    STAGES = ('decode', 'resize', 'watermark', 'composite', 'queue_wait', 'encode', 'write')
+
+    def __init__(self):
+        self.photos = dict.fromkeys(('exported', 'skipped', 'error', 'cancelled'), 0)
+        self.totals = self.new_task()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def new_task(cls):
+        return {'stages': dict.fromkeys(cls.STAGES, 0.0), 'bytes_in': 0, 'bytes_out': 0, 'in_flight': 0}
+
+    def record(self, task_metrics, outcome, result=None):
+        with self._lock:
+            self.photos[outcome] += 1
+            if result is None:
+                return
+            for m in (self.totals, task_metrics):
+                if m is None:
+                    continue
+                m['bytes_in'] += result['bytes_in']
+                m['bytes_out'] += result['bytes_out']
+                for k, v in (result['stages'] or {}).items():
+                    m['stages'][k] = round(m['stages'][k] + v, 4)
+
+    def render(self):
+        """Prometheus 文本格式"""
+        in_flight = len(_photo_futures)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{labels} {value}')
+
+        with self._lock:
+            metric('wm_photos_total', 'counter', '处理过的照片数',
+                   [(f'{{result="{k}"}}', v) for k, v in self.photos.items()])
+            metric('wm_bytes_read_total', 'counter', '读入的源文件字节数', [('', self.totals['bytes_in'])])
+            metric('wm_bytes_written_total', 'counter', '写出的文件字节数', [('', self.totals['bytes_out'])])
+            if METRICS_ENABLED:
+                metric('wm_stage_seconds_total', 'counter', '各步骤在工作进程里的累计耗时',
+                       [(f'{{stage="{k}"}}', v) for k, v in self.totals['stages'].items()])
+        metric('wm_tasks', 'gauge', '各状态的导出任务数',
+               [(f'{{status="{st}"}}', sum(1 for t in list(export_tasks.values()) if t['status'] == st))
+                for st in ('queued', 'processing')])
+        metric('wm_task_queue_depth', 'gauge', '排队等待执行的任务数', [('', scheduler.queue_depth())])
+        metric('wm_photos_in_flight', 'gauge', '已提交到进程池还没完成的照片数', [('', in_flight)])
+        metric('wm_export_workers', 'gauge', '导出进程数', [('', EXPORT_WORKERS)])
+        metric('wm_active_workers', 'gauge', '正在处理照片的导出进程数',
+               [('', min(in_flight, EXPORT_WORKERS) if _export_pool is not None else 0)])
+        metric('wm_memory_budget_used_bytes', 'gauge', '在处理照片的估算内存', [('', memory_budget.used)])
+        metric('wm_memory_budget_limit_bytes', 'gauge', '内存预算，0 为不限制', [('', memory_budget.limit)])
+        metric('wm_watermark_cache_hits_total', 'counter', '工作进程水印缓存命中数', [('', wm_cache_stats['hits'])])
+        metric('wm_watermark_cache_misses_total', 'counter', '工作进程水印缓存未命中数',
+               [('', wm_cache_stats['misses'])])
+        return '\n'.join(lines) + '\n'
+
+export_metrics = ExportMetrics()
+
+def do_export(task_id, photo_paths, export_path, watermark_data, cfg, temp_dir, cancel=None):
+    """photo_paths 可以是列表，也可以是上传过程中逐个给出路径的迭代器
+
+    cancel 被设置后不再提交新照片，还没开始处理的也取消掉。
+    """
+    task = export_tasks[task_id]
     try:
         out_dir = Path(export_path)
         out_dir.mkdir(parents=True, exist_ok=True)
         print(f"[Export] Output dir: {out_dir}")
 
-        if watermark_data.startswith('data:'):
-            watermark_data = watermark_data.split(',')[1]
-        wm = Image.open(io.BytesIO(base64.b64decode(watermark_data))).convert('RGBA')
-
+        # 工作进程按 hash 自己读水印文件，提交照片时不再带上水印内容
+        wm_key = watermarks.resolve(watermark_data)
+        cfg, overrides = split_overrides(cfg)
+        out_opts = resolve_output(cfg)
+        for h in {p.get('watermark') for p in cfg.get('presets') or []} | {o.get('watermark') for o in overrides.values()}:
+            if h and watermarks.get(h) is None:
+                raise ValueError(f'预设里的水印不存在，请重新上传: {h[:8]}')
+
+        manifest = ExportManifest(out_dir)
+        used_names = set()
+        pending = deque()
+        metrics = None
+        if METRICS_ENABLED:
+            metrics = task['metrics'] = ExportMetrics.new_task()
         exported_count = 0
-        for i, p in enumerate(photo_paths):
-            try:
-                export_tasks[task_id]['current'] = i + 1
-                export_tasks[task_id]['message'] = f'{i+1}/{len(photo_paths)} {Path(p).name}'
-
-                img = Image.open(p).convert('RGBA')
-                orient = 'landscape' if img.width > img.height else 'portrait'
-                s = cfg.get(orient, cfg.get('landscape', {}))
-
-                sz = s.get('size', 15) / 100
-                op = s.get('opacity', 80) / 100
-                xp = s.get('x', 95) / 100
-                yp = s.get('y', 95) / 100
-
-                wm_w = int(img.width * sz)
-                wm_h = int(wm_w * wm.height / wm.width)
-                wm_r = wm.resize((wm_w, wm_h), Image.Resampling.LANCZOS)
-
-                if op < 1:
-                    a = wm_r.split()[3].point(lambda x: int(x * op))
-                    wm_r.putalpha(a)
-
-                x = int((img.width - wm_w) * xp)
-                y = int((img.height - wm_h) * yp)
-                img.paste(wm_r, (x, y), wm_r)
-
-                # 文件名：如果已存在则加时间戳
-                base_name = Path(p).stem
-                ext = Path(p).suffix or '.jpg'
-                out_file = out_dir / f'wm_{base_name}{ext}'
-                if out_file.exists():
-                    ts = int(time.time() * 1000) % 100000
-                    out_file = out_dir / f'wm_{base_name}_{ts}{ext}'
-
-                img.convert('RGB').save(str(out_file), quality=95)
-                exported_count += 1
-                print(f"[Export] Saved: {out_file}")
-
-            except Exception as e:
-                print(f"[Export] Error processing {p}: {e}")
-
-        export_tasks[task_id]['status'] = 'done'
-        export_tasks[task_id]['message'] = f'完成 {exported_count} 张'
-        subprocess.run(['open', str(out_dir)])
-
-        import shutil
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        time.sleep(30)
-        export_tasks.pop(task_id, None)
+        skipped_count = 0
+        failed_count = 0
+        done_count = 0
+        # 失败的照片记在任务里，/task_status 和进度推送里能看到是哪张、为什么
+        errors = task['errors'] = []
+        outputs = task_outputs.setdefault(task_id, [])
+
+        # 重启后接着做的任务：已经处理过的照片从任务库里恢复计数、输出文件名和清单记录
+        for path, status, out_name, entry, error in task_store.completed(task_id):
+            done_count += 1
+            if out_name:
+                used_names.add(out_name)
+            if status in ('exported', 'skipped'):
+                exported_count += status == 'exported'
+                skipped_count += status == 'skipped'
+                outputs.append(str(out_dir / out_name))
+                if entry:
+                    manifest.put(out_name, entry)
+            elif status == 'failed':
+                failed_count += 1
+                if len(errors) < MAX_TASK_ERRORS:
+                    errors.append({'photo': Path(path).name, 'error': error})
+        if failed_count:
+            task['failed'] = failed_count
+        task['current'] = done_count
+
+        # 按提交顺序回收结果，保证进度有序；block=False 时只回收已经完成的
+        def collect(block):
+            nonlocal exported_count, skipped_count, failed_count, done_count
+            while pending:
+                p, fut, out_file = pending[0]
+                if not fut.done():
+                    if not block:
+                        return
+                    # 等待期间也要响应取消：还没开始的照片直接取消
+                    if cancel is not None and cancel.is_set():
+                        for _, f, _ in pending:
+                            f.cancel()
+                    wait([fut], timeout=0.5)
+                    continue
+                pending.popleft()
+                seconds = error = entry = None
+                try:
+                    result = fut.result()
+                    seconds = round(result['seconds'], 3)
+                    entry = result['entry']
+                    manifest.put(Path(result['out_file']).name, entry)
+                    outputs.append(result['out_file'])
+                    if result['skipped']:
+                        skipped_count += 1
+                        status = 'skipped'
+                        export_metrics.record(metrics, 'skipped', result)
+                    else:
+                        wm_cache_stats['hits' if result['wm_cache_hit'] else 'misses'] += 1
+                        exported_count += 1
+                        status = 'exported'
+                        export_metrics.record(metrics, 'exported', result)
+                        print(f"[Export] Saved: {result['out_file']}")
+                except CancelledError:
+                    status = 'cancelled'
+                    export_metrics.record(metrics, 'cancelled')
+                except Exception as e:
+                    status = 'failed'
+                    export_metrics.record(metrics, 'error')
+                    print(f"[Export] Error processing {p}: {e}")
+                    failed_count += 1
+                    error = str(e) or type(e).__name__
+                    if len(errors) < MAX_TASK_ERRORS:
+                        errors.append({'photo': Path(p).name, 'error': error})
+                    task['failed'] = failed_count
+                if metrics is not None:
+                    metrics['in_flight'] = len(pending)
+                done_count += 1
+                task['current'] = done_count
+                task['message'] = f'{done_count}/{task["total"]} {Path(p).name}'
+                task_store.photo_done(task_id, p, status, task, out_file.name, entry, error)
+                if temp_dir:
+                    # 临时文件处理完立刻删除，不等整批结束；结果记进任务库之后再删，重启后不会丢照片
+                    Path(p).unlink(missing_ok=True)
+                task_events.publish(task_id, photo=Path(p).name, photo_seconds=seconds, photo_error=error)
+
+        # 内存预算不够时等前面的照片处理完，等待期间照常回收进度、响应取消
+        def admit(nbytes):
+            while not memory_budget.acquire(nbytes, timeout=0.5):
+                collect(block=False)
+                if cancel is not None and cancel.is_set():
+                    return False
+            return True
+
+        for p in photo_paths:
+            if cancel is not None and cancel.is_set():
+                break
+            if not isinstance(photo_paths, (list, tuple)):
+                # 边上传边导出时照片收到一张登记一张，列表在建任务时已经全部登记
+                task_store.add_photo(task_id, p)
+            nbytes = estimate_memory(p, out_opts)
+            if not admit(nbytes):
+                break
+            out_file = output_path(out_dir, p, used_names, output_format(p, out_opts)[1])
+            fut = submit_photo(p, out_file, wm_key, None, cfg, manifest.get(out_file.name),
+                               overrides.get(Path(p).name))
+            fut.add_done_callback(lambda f, n=nbytes: memory_budget.release(n))
+            pending.append((p, fut, out_file))
+            if metrics is not None:
+                metrics['in_flight'] = len(pending)
+            collect(block=False)
+        collect(block=True)
+        manifest.save()
+
+        if cancel is not None and cancel.is_set():
+            finish_task(task_id, 'cancelled', f'已取消，完成 {exported_count} 张')
+        else:
+            task['total'] = done_count
+            finish_task(task_id, 'done', f'完成 {exported_count} 张' +
+                        (f'，{skipped_count} 张未变化已跳过' if skipped_count else '') +
+                        (f'，{failed_count} 张失败' if failed_count else ''))
+            # 浏览器和服务端在同一台 Mac 上时直接打开导出目录；其他情况从任务上的下载链接取 ZIP
+            if sys.platform == 'darwin':
+                subprocess.run(['open', str(out_dir)])
+
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
     except Exception as e:
         import traceback; traceback.print_exc()
-        export_tasks[task_id]['status'] = 'error'
-        export_tasks[task_id]['message'] = str(e)
+        finish_task(task_id, 'error', str(e))
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
 @app.route('/task_status/<task_id>')
 def task_status(task_id):
-    return jsonify(export_tasks.get(task_id, {'status': 'not_found'}))
+    return jsonify(task_state(task_id))
+
+@app.route('/events')
+@app.route('/events/<task_id>')
+def events(task_id=None):
+    """SSE 推送任务进度：/events 是全部任务，/events/<task_id> 只推一个任务，结束后断开
+
+    连上时先把当前状态发一遍，之后每张照片完成、状态变化都会推送，
+    每张照片的事件带 photo 和 photo_seconds（单张耗时）。
+    """
+    q = task_events.subscribe(task_id)
+    snapshot = task_snapshot(task_id)
+
+    def stream():
+        try:
+            yield 'retry: 2000\n\n'
+            for event in snapshot:
+                yield sse_message(event)
+            if task_id and snapshot and is_finished(snapshot[0]):
+                return
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield sse_message(event)
+                if task_id and is_finished(event):
+                    return
+        finally:
+            task_events.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class _ZipSink(io.RawIOBase):
+    """zipfile 写到这里，每写一块就被生成器取走，压缩包不落盘也不在内存里攒着
+
+    不支持 seek，zipfile 会改用数据描述符写每个文件的 CRC 和大小。
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        return len(b)
+
+    def take(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+@app.route('/task_download/<task_id>')
+def task_download(task_id):
+    """把任务的导出结果打成 ZIP 边生成边下载：导出还没结束时先发已完成的，之后每完成一张追加一张
+
+    输出都是 JPEG/WebP/AVIF/PNG 这类已经压缩过的格式，用 ZIP_STORED 不再压缩。
+    已经从内存里清掉的任务（结束超过 TASK_TTL、重启前的任务）按任务库里记的输出文件打包。
+    """
+    live = task_id in export_tasks
+    if live:
+        files = task_outputs.setdefault(task_id, [])
+    else:
+        files = task_store.outputs(task_id)
+        if files is None:
+            return jsonify({'error': '任务不存在'}), 404
+    q = task_events.subscribe(task_id)
+
+    def stream():
+        sink = _ZipSink()
+        sent = 0
+        try:
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+                while True:
+                    # 先看状态再发文件：结束前完成的照片一定已经在 files 里
+                    finished = not live or is_finished(export_tasks.get(task_id) or {'status': 'error'})
+                    while sent < len(files):
+                        path = Path(files[sent])
+                        sent += 1
+                        try:
+                            zinfo = zipfile.ZipInfo.from_file(path, path.name)
+                        except OSError:
+                            continue
+                        with open(path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+                            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                                dest.write(chunk)
+                                yield sink.take()
+                        yield sink.take()
+                    if finished:
+                        break
+                    try:
+                        q.get(timeout=1)
+                    except queue.Empty:
+                        pass
+            yield sink.take()
+        finally:
+            task_events.unsubscribe(q)
+
+    return Response(stream(), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="watermarked_{task_id}.zip"',
+                             'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/task_cancel/<task_id>', methods=['POST'])
+def task_cancel(task_id):
+    return jsonify({'success': scheduler.cancel(task_id)})
+
+@app.route('/cache_stats')
+def cache_stats():
+    total = wm_cache_stats['hits'] + wm_cache_stats['misses']
+    return jsonify({'watermark': dict(wm_cache_stats,
+                                      hit_rate=round(wm_cache_stats['hits'] / total, 4) if total else 0)})
+
+@app.route('/metrics')
+def metrics():
+    return Response(export_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ASGI 模式：uvicorn app:asgi_app 或 python app.py --asgi
+# 流式上传、任务状态、进度推送、保存配置直接在事件循环里处理，慢上传不会占住线程；
+# 其他路由交给 Flask 在线程池里跑。合成和编码仍然在导出进程池里。
+# 导出任务由本进程调度，只能单进程运行（不要开 uvicorn --workers）；没做完的任务在 lifespan 启动时恢复。
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.to_thread(resume_tasks)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    if path == '/export_stream' and method == 'POST':
+        await _asgi_export_stream(scope, receive, send)
+    elif path.startswith('/task_status/') and method == 'GET':
+        task_id = path[len('/task_status/'):]
+        await _asgi_json(send, task_state(task_id))
+    elif (path == '/events' or path.startswith('/events/')) and method == 'GET':
+        await _asgi_events(receive, send, path[len('/events/'):] or None)
+    elif path == '/save_config' and method == 'POST':
+        body = await _asgi_body(receive)
+        await asyncio.to_thread(save_config, json.loads(body))
+        await _asgi_json(send, {'success': True})
+    else:
+        await _asgi_wsgi(scope, receive, send)
+
+async def _asgi_json(send, data):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(data, ensure_ascii=False).encode()})
+
+async def _asgi_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('客户端已断开')
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def _asgi_export_stream(scope, receive, send):
+    """同 /export_stream：请求体边收边交给 UploadIngest，写盘放到线程里做"""
+    ingest = None
+    try:
+        headers = dict(scope['headers'])
+        ctype, opts = parse_options_header(headers.get(b'content-type', b'').decode('latin-1'))
+        if ctype != 'multipart/form-data' or not opts.get('boundary'):
+            return await _asgi_json(send, {'error': '需要 multipart/form-data'})
+
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        task_id = stream_task_id(query.get('task_id', [''])[0])
+        ingest = UploadIngest(opts['boundary'].encode(), task_id)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('上传中断')
+            if message.get('body'):
+                await asyncio.to_thread(ingest.feed, message['body'])
+            if not message.get('more_body'):
+                break
+        await asyncio.to_thread(ingest.feed, None)
+        await _asgi_json(send, {'task_id': task_id, 'received': ingest.received})
+    except Exception as e:
+        import traceback; traceback.print_exc()
+        if ingest is not None and ingest.started:
+            ingest.finish()
+        await _asgi_json(send, {'error': str(e)})
+
+async def _asgi_events(receive, send, task_id):
+    """同 /events：每个连接一个 asyncio.Queue，不占线程；客户端断开时退出"""
+    await _asgi_body(receive)
+    q = task_events.subscribe(task_id, asyncio.get_running_loop())
+    snapshot = task_snapshot(task_id)
+    # 请求体收完之后 receive 只会在客户端断开时返回
+    disconnected = asyncio.ensure_future(receive())
+
+    async def push(text):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        await push('retry: 2000\n\n')
+        for event in snapshot:
+            await push(sse_message(event))
+        finished = task_id and snapshot and is_finished(snapshot[0])
+        while not finished:
+            getter = asyncio.ensure_future(q.get())
+            done, _ = await asyncio.wait([getter, disconnected], timeout=15,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                getter.cancel()
+                return
+            if getter not in done:
+                getter.cancel()
+                await push(': keepalive\n\n')
+                continue
+            event = getter.result()
+            await push(sse_message(event))
+            finished = task_id and is_finished(event)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        task_events.unsubscribe(q)
+
+def _wsgi_environ(scope, body, length):
+    server = scope.get('server') or ('127.0.0.1', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+async def _asgi_wsgi(scope, receive, send):
+    """其他路由转给 Flask：请求体先收完（大的落到临时文件），Flask 和响应迭代都在线程池里跑"""
+    loop = asyncio.get_running_loop()
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as body:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            if message.get('body'):
+                await loop.run_in_executor(None, body.write, message['body'])
+            if not message.get('more_body'):
+                break
+        length = body.tell()
+        body.seek(0)
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: None
+
+        result = await loop.run_in_executor(None, app, _wsgi_environ(scope, body, length), start_response)
+        try:
+            chunks = iter(result)
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': response['status'],
+                        'headers': response['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(None, result.close)
+
+PHOTO_EXTS = ('.jpg', '.jpeg', '.png', '.heic', '.heif')
+
+def collect_inputs(inputs):
+    """命令行输入可以是文件夹、单个文件或通配符"""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files += sorted(str(p) for p in Path(item).iterdir() if p.suffix.lower() in PHOTO_EXTS)
+        else:
+            files += sorted(p for p in glob.glob(item) if Path(p).suffix.lower() in PHOTO_EXTS)
+    # 去重但保持顺序
+    return list(dict.fromkeys(files))
+
+def run_batch(inputs, watermark, config_path, out_dir, workers=None, force=False):
+    """命令行批量导出，和网页导出用同一套合成逻辑"""
+    global EXPORT_WORKERS
+    if workers:
+        EXPORT_WORKERS = workers
+
+    files = collect_inputs(inputs)
+    if not files:
+        print('[Batch] 没有找到图片')
+        return 1
+
+    config_path = Path(config_path) if config_path else CONFIG_FILE
+    if config_path.exists():
+        with open(config_path, 'r') as f:
+            cfg = json.load(f)
+    else:
+        print(f'[Batch] 配置文件不存在，使用默认设置: {config_path}')
+        cfg = default_config.copy()
+
+    wm_bytes = Path(watermark).read_bytes()
+    wm_key = hashlib.sha1(wm_bytes).hexdigest()
+    Image.open(io.BytesIO(wm_bytes)).verify()
+    cfg, overrides = split_overrides(cfg)
+    out_opts = resolve_output(cfg)
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # 输出比源文件新、清单里记的水印和设置跟这次一样的视为已是最新，跳过（只读文件头）；
+    # 其余的交给工作进程按清单比对内容hash
+    manifest = ExportManifest(out_dir)
+
+    def up_to_date(p, out_file):
+        entry = manifest.get(out_file.name)
+        if not entry or entry.get('output') != out_opts or not out_file.exists() or \
+                out_file.stat().st_mtime < os.path.getmtime(p):
+            return False
+        try:
+            with Image.open(p) as img:
+                orientation = exif_orientation(img)
+                dw, dh = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+        except Exception:
+            return False
+        preset, s, preset_wm = preset_table(cfg).resolve(dw, dh, overrides.get(Path(p).name))
+        return entry.get('wm_hash') == (preset_wm or wm_key) and entry.get('settings') == s and \
+            entry.get('preset') == preset and entry.get('orientation') == orientation
+
+    used_names = set()
+    jobs, skipped = [], 0
+    for p in files:
+        out_file = output_path(out_dir, p, used_names, output_format(p, out_opts)[1])
+        if not force and up_to_date(p, out_file):
+            skipped += 1
+            continue
+        jobs.append((p, out_file))
+
+    print(f'[Batch] {len(files)} 张，跳过 {skipped} 张已是最新，待处理 {len(jobs)} 张，{EXPORT_WORKERS} 个进程')
+    if not jobs:
+        return 0
+    start = time.time()
+    exported, unchanged, failed, bytes_in = 0, 0, 0, 0
+    pending = deque()
+
+    def submit(p, out_file):
+        # 按内存预算放行，等待时先把前面的结果收掉
+        nbytes = estimate_memory(p, out_opts)
+        while not memory_budget.acquire(nbytes, timeout=0.5):
+            while pending and pending[0][2].done():
+                report(*pending.popleft())
+        fut = submit_photo(p, out_file, wm_key, wm_bytes, cfg, None if force else manifest.get(out_file.name),
+                           overrides.get(Path(p).name))
+        fut.add_done_callback(lambda f: memory_budget.release(nbytes))
+        pending.append((p, out_file, fut))
+
+    def report(p, out_file, fut):
+        nonlocal exported, unchanged, failed, bytes_in
+        i = exported + unchanged + failed
+        try:
+            result = fut.result()
+            manifest.put(out_file.name, result['entry'])
+            if result['skipped']:
+                unchanged += 1
+                print(f'[Batch] {i+1}/{len(jobs)} 未变化 {out_file}')
+                return
+            exported += 1
+            bytes_in += os.path.getsize(p)
+            print(f'[Batch] {i+1}/{len(jobs)} {out_file}')
+        except Exception as e:
+            failed += 1
+            print(f'[Batch] {i+1}/{len(jobs)} Error processing {p}: {e}')
+
+    for p, out_file in jobs:
+        submit(p, out_file)
+    while pending:
+        report(*pending.popleft())
+    manifest.save()
+
+    elapsed = time.time() - start
+    mb = bytes_in / 1024 / 1024
+    print(f'[Batch] 完成 {exported} 张，内容未变化 {unchanged} 张，失败 {failed} 张，耗时 {elapsed:.2f}s，'
+          f'{exported / elapsed if elapsed else 0:.2f} 张/s，{mb / elapsed if elapsed else 0:.1f} MB/s')
+    return 1 if failed else 0
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='水印工具：不带参数启动网页版，batch 子命令用于命令行批量导出')
+    sub = parser.add_subparsers(dest='command')
+    batch = sub.add_parser('batch', help='命令行批量导出')
+    batch.add_argument('inputs', nargs='+', help='图片文件夹、文件或通配符（如 "shoot/*.jpg"）')
+    batch.add_argument('-w', '--watermark', required=True, help='PNG水印图片')
+    batch.add_argument('-c', '--config', help=f'watermark_config.json 路径，默认 {CONFIG_FILE}')
+    batch.add_argument('-o', '--output', required=True, help='输出文件夹')
+    batch.add_argument('-j', '--workers', type=int, help='并行进程数，默认 WM_EXPORT_WORKERS 或CPU核心数')
+    batch.add_argument('-f', '--force', action='store_true', help='不跳过已是最新的文件')
+    parser.add_argument('--asgi', action='store_true', help='用 uvicorn 以 ASGI 模式运行（需安装 uvicorn），适合多人同时上传')
+    args = parser.parse_args(argv)
+
+    if args.command == 'batch':
+        return run_batch(args.inputs, args.watermark, args.config, args.output, args.workers, args.force)
+
+    if args.asgi:
+        try:
+            import uvicorn
+        except ImportError:
+            print('ASGI 模式需要 uvicorn: pip install uvicorn')
+            return 1
 
-if __name__ == '__main__':
     import webbrowser
     port = 5051
     threading.Timer(1.0, lambda: webbrowser.open(f'http://127.0.0.1:{port}')).start()
     print(f'\n水印工具: http://127.0.0.1:{port}\n')
-    app.run(port=port, debug=False, threaded=True)
+    if args.asgi:
+        uvicorn.run(asgi_app, host='127.0.0.1', port=port, log_level='warning')
+    else:
+        resume_tasks()
+        app.run(port=port, debug=False, threaded=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+水印工具性能测试
+blend:  比较 pillow 和 numpy 两种水印混合实现的速度和结果差异
+export: 用合成照片集跑完整导出流程，输出吞吐、单张耗时分位数和峰值内存（JSON）
+stages: 单线程逐张拆开计时：解码、缩放水印、透明度、合成、编码、写盘（JSON）
+tile:   平铺水印：缓存旋转好的水印和位置前后的合成耗时，对比一次混合整张照片
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from PIL import Image, ImageChops, ImageDraw
+
+import app
+
+
+def synthetic_photo(width, height, seed=0):
+    """带渐变和线条的合成照片，避免纯色图让混合结果失去参考意义"""
+    img = Image.linear_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (img, img.rotate(90).resize((width, height)), Image.new('L', (width, height), 90 + seed)))
+    d = ImageDraw.Draw(img)
+    for i in range(0, width, max(1, width // 40)):
+        d.line([(i, 0), (width - i, height)], fill=((i * 7 + seed) % 256, 60, 200), width=3)
+    return img
+
+
+def synthetic_watermark(width=800, height=300):
+    """半透明渐变底加不透明文字的RGBA水印"""
+    wm = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    d = ImageDraw.Draw(wm)
+    for i in range(height):
+        d.line([(0, i), (width, i)], fill=(255, 255, 255, int(200 * i / height)))
+    d.ellipse([width // 4, height // 4, width * 3 // 4, height * 3 // 4], fill=(240, 87, 108, 255))
+    d.text((20, 20), 'ONEMAPLE', fill=(0, 0, 0, 255))
+    return wm
+
+
+def bench_blend(args):
+    if app.np is None:
+        print('没有安装 numpy，只能测 pillow')
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    photo = synthetic_photo(width, height)
+    wm = synthetic_watermark()
+    op = args.opacity / 100
+    wm_w = int(width * args.wm_size / 100)
+    wm_h = int(wm_w * wm.height / wm.width)
+    # 放在右下角并超出边界一点，覆盖裁剪的分支
+    x, y = int((width - wm_w) * 1.05), int((height - wm_h) * 0.95)
+
+    results = {}
+    for backend in ['pillow', 'numpy'] if app.np is not None else ['pillow']:
+        times = []
+        for i in range(args.repeat):
+            img = photo.copy()
+            t = time.perf_counter()
+            tile = app.prepare_watermark(wm, (wm_w, wm_h), op, backend)
+            app.composite_watermark(img, tile, x, y)
+            times.append(time.perf_counter() - t)
+        results[backend] = img
+        times.sort()
+        print(f'{backend:>6}: 中位 {times[len(times) // 2] * 1000:.2f} ms，最快 {times[0] * 1000:.2f} ms'
+              f'（{args.repeat} 次，含缩放水印和透明度处理）')
+
+        # 命中缓存后的情况：只计混合本身
+        tile = app.prepare_watermark(wm, (wm_w, wm_h), op, backend)
+        times = []
+        for i in range(args.repeat):
+            img = photo.copy()
+            t = time.perf_counter()
+            app.composite_watermark(img, tile, x, y)
+            times.append(time.perf_counter() - t)
+        times.sort()
+        print(f'{"":>6}  仅混合: 中位 {times[len(times) // 2] * 1000:.2f} ms')
+
+    if len(results) == 2:
+        diff = max(hi for lo, hi in ImageChops.difference(results['pillow'], results['numpy']).getextrema())
+        print(f'最大像素差: {diff}' + ('' if diff <= 1 else '  (超出 ±1!)'))
+        return 0 if diff <= 1 else 1
+    return 0
+
+
+def bench_tile(args):
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    photo = synthetic_photo(width, height)
+    wm = synthetic_watermark()
+    op = args.opacity / 100
+    wm_w = int(width * args.wm_size / 100)
+    wm_h = int(wm_w * wm.height / wm.width)
+    tile = (width, height, args.spacing, args.angle)
+
+    # 不缓存：每张照片都重新缩放、旋转水印，排位置
+    times = []
+    for i in range(args.repeat):
+        img = photo.copy()
+        t = time.perf_counter()
+        tiled = app.prepare_tiled_watermark(wm, (wm_w, wm_h), op, tile)
+        app.composite_watermark(img, tiled, 0, 0)
+        times.append(time.perf_counter() - t)
+    times.sort()
+    uncached = times[len(times) // 2]
+
+    # 命中缓存：只剩逐格混合
+    times = []
+    for i in range(args.repeat):
+        img = photo.copy()
+        t = time.perf_counter()
+        app.composite_watermark(img, tiled, 0, 0)
+        times.append(time.perf_counter() - t)
+    times.sort()
+    cached = times[len(times) // 2]
+
+    # 对照：同样大小的单个水印铺满整张照片，一次混合
+    full = app.prepare_watermark(wm, (width, height), op)
+    img = photo.copy()
+    t = time.perf_counter()
+    app.composite_watermark(img, full, 0, 0)
+    single = time.perf_counter() - t
+    layout = f'{len(tiled.positions)} 格' if len(tiled.positions) > 1 else '拼成整层'
+    print(f'{layout}，不缓存 {uncached * 1000:.1f} ms，命中缓存 {cached * 1000:.1f} ms；'
+          f'一次混合整张照片 {single * 1000:.1f} ms')
+    return 0
+
+
+def make_photo_set(data_dir, megapixels, formats, count, portrait, seed=0):
+    """按 尺寸 x 格式 各生成 count 张 3:2 照片，portrait 为竖图比例；已存在的文件直接复用"""
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for mp in megapixels:
+        w = int((mp * 1e6 * 1.5) ** 0.5)
+        h = int(w / 1.5)
+        base = None
+        for fmt in formats:
+            ext = '.jpg' if fmt == 'jpeg' else '.png'
+            for i in range(count):
+                tall = i < round(count * portrait)
+                p = data_dir / f'{mp:g}mp_{i:03d}{"_p" if tall else ""}{ext}'
+                if not p.exists():
+                    if base is None:
+                        base = synthetic_photo(w, h, seed)
+                    img = base.transpose(Image.Transpose.ROTATE_90) if tall else base
+                    if fmt == 'jpeg':
+                        img.save(p, 'JPEG', quality=92)
+                    else:
+                        img.save(p, 'PNG', compress_level=1)
+                paths.append(str(p))
+    return paths
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def peak_rss_mb():
+    """本进程和已退出子进程（导出进程池关闭后）的峰值常驻内存；Linux 上单位是KB，macOS 上是字节"""
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return {'parent': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 / 1024, 1),
+            'workers': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1024 / 1024, 1)}
+
+
+def bench_config(args):
+    return {'landscape': {'x': 95, 'y': 95, 'size': args.wm_size, 'opacity': args.opacity},
+            'portrait': {'x': 50, 'y': 90, 'size': args.wm_size * 2, 'opacity': args.opacity},
+            'output': {'format': args.format, 'quality': args.quality, 'max_edge': args.max_edge}}
+
+
+def isolate_app(work):
+    """水印、任务库、各种缓存都改到临时目录，不碰 output/ 里正在用的数据；要在进程池启动前调用"""
+    app.WATERMARK_DIR = work / 'watermarks'
+    app.DECODE_CACHE_DIR = work / 'decode_cache'
+    app.PROXY_CACHE_DIR = work / 'proxy_cache'
+    app.BLOB_DIR = app.blobs.root = work / 'blobs'
+    app.TASK_DB = app.task_store.path = work / 'tasks.db'
+
+
+def run_export(paths, out_dir, watermark_data, cfg, run):
+    """跑一次 do_export，从进度事件里拿每张照片在工作进程里的耗时"""
+    task_id = f'bench-{run}'
+    app.export_tasks[task_id] = {'status': 'processing', 'current': 0, 'total': len(paths), 'message': ''}
+    events = app.task_events.subscribe(task_id)
+    start = time.perf_counter()
+    try:
+        app.do_export(task_id, paths, out_dir, watermark_data, cfg, None)
+    finally:
+        app.task_events.unsubscribe(events)
+    elapsed = time.perf_counter() - start
+
+    latencies, status = [], None
+    while not events.empty():
+        event = events.get_nowait()
+        if event.get('photo_seconds') is not None:
+            latencies.append(event['photo_seconds'])
+        if status is None and event['status'] in ('done', 'error', 'cancelled'):
+            status = event['status']
+    stages = (app.export_tasks.pop(task_id, {}).get('metrics') or {}).get('stages')
+
+    mb_in = sum(os.path.getsize(p) for p in paths) / 1024 / 1024
+    mb_out = sum(f.stat().st_size for f in Path(out_dir).iterdir() if not f.name.startswith('.')) / 1024 / 1024
+    return {'run': run, 'status': status, 'photos': len(paths), 'exported': len(latencies),
+            'seconds': round(elapsed, 3),
+            'photos_per_sec': round(len(paths) / elapsed, 2),
+            'mb_per_sec': round(mb_in / elapsed, 1),
+            'mb_in': round(mb_in, 1), 'mb_out': round(mb_out, 1),
+            'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'latency_p95_ms': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+            'stage_seconds': stages}
+
+
+def bench_export(args):
+    if args.workers:
+        app.EXPORT_WORKERS = args.workers
+    work = Path(tempfile.mkdtemp(prefix='wm_bench_'))
+    data_dir = Path(args.data) if args.data else work / 'photos'
+    isolate_app(work)
+    try:
+        paths = make_photo_set(data_dir, args.mp, args.formats, args.count, args.portrait)
+        buf = io.BytesIO()
+        synthetic_watermark().save(buf, 'PNG')
+        watermark_data = 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+        cfg = bench_config(args)
+
+        # 每轮写到新目录，避免被清单当成未变化跳过；第一轮包含进程池启动
+        runs = [run_export(paths, work / f'out{i}', watermark_data, cfg, i) for i in range(args.repeat)]
+        app.get_export_pool().shutdown(wait=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {'benchmark': 'export', 'params': {k: v for k, v in vars(args).items() if k not in ('func', 'command')},
+              'workers': app.EXPORT_WORKERS, 'blend_backend': app.BLEND_BACKEND,
+              'runs': runs, 'peak_rss_mb': peak_rss_mb()}
+    return write_report(report, args.json)
+
+
+def bench_stages(args):
+    """逐张照片单线程计时，各步骤和 export_photo 里的做法一致"""
+    work = Path(tempfile.mkdtemp(prefix='wm_bench_'))
+    data_dir = Path(args.data) if args.data else work / 'photos'
+    stages = {k: [] for k in ('decode', 'resize_watermark', 'alpha_scale', 'paste', 'encode', 'write')}
+    try:
+        paths = make_photo_set(data_dir, args.mp, args.formats, args.count, args.portrait)
+        wm = synthetic_watermark()
+        cfg = bench_config(args)
+        opts = app.resolve_output(cfg)
+        for i, p in enumerate(paths):
+            t = time.perf_counter()
+            img = Image.open(io.BytesIO(Path(p).read_bytes()))
+            max_edge = opts['max_edge']
+            if max_edge and img.format == 'JPEG' and max(img.size) > max_edge:
+                img.draft('RGB', app.draft_target(img.width, img.height, max_edge))
+            img = img.convert('RGB')
+            if max_edge and max(img.size) > max_edge:
+                img = img.resize(app.draft_target(img.width, img.height, max_edge),
+                                 Image.Resampling.LANCZOS, reducing_gap=3.0)
+            stages['decode'].append(time.perf_counter() - t)
+
+            s = app.resolve_settings(cfg, img.width, img.height)
+            wm_w = int(img.width * s['size'] / 100)
+            wm_h = int(wm_w * wm.height / wm.width)
+            t = time.perf_counter()
+            wm_r = wm.resize((wm_w, wm_h), Image.Resampling.LANCZOS)
+            stages['resize_watermark'].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            op = s['opacity'] / 100
+            wm_r.putalpha(wm_r.split()[3].point(lambda x: int(x * op)))
+            stages['alpha_scale'].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            app.composite_watermark(img, wm_r, int((img.width - wm_w) * s['x'] / 100),
+                                    int((img.height - wm_h) * s['y'] / 100))
+            stages['paste'].append(time.perf_counter() - t)
+
+            fmt = app.output_format(p, opts)[0]
+            t = time.perf_counter()
+            buf = io.BytesIO()
+            img.save(buf, fmt, **app.encode_params(fmt, opts))
+            stages['encode'].append(time.perf_counter() - t)
+
+            t = time.perf_counter()
+            out = work / f'out_{i}'
+            out.write_bytes(buf.getvalue())
+            stages['write'].append(time.perf_counter() - t)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {'benchmark': 'stages', 'params': {k: v for k, v in vars(args).items() if k not in ('func', 'command')},
+              'photos': len(paths), 'stages': {}, 'peak_rss_mb': peak_rss_mb()}
+    for name, times in stages.items():
+        report['stages'][name] = {'total_s': round(sum(times), 3),
+                                  'p50_ms': round(percentile(times, 50) * 1000, 2),
+                                  'p95_ms': round(percentile(times, 95) * 1000, 2)}
+    return write_report(report, args.json)
+
+
+def write_report(report, path):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path:
+        Path(path).write_text(text)
+    print(text)
+    return 0 if all(r.get('status') in (None, 'done') for r in report.get('runs', [])) else 1
+
+
+def add_set_args(parser):
+    parser.add_argument('--mp', type=lambda v: [float(x) for x in v.split(',')], default=[12.0, 24.0],
+                        help='照片像素数（百万），逗号分隔，默认 12,24')
+    parser.add_argument('--formats', type=lambda v: v.split(','), default=['jpeg'],
+                        help='照片格式 jpeg,png，默认 jpeg')
+    parser.add_argument('--count', type=int, default=10, help='每种尺寸、格式各多少张，默认 10')
+    parser.add_argument('--portrait', type=float, default=0.3, help='竖图比例，默认 0.3')
+    parser.add_argument('--data', help='照片集目录，指定后生成的照片保留下来复用')
+    parser.add_argument('--wm-size', type=int, default=15, help='水印宽度占照片的百分比')
+    parser.add_argument('--opacity', type=int, default=80)
+    parser.add_argument('--format', default='original', help='输出格式，同配置里的 output.format')
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('--max-edge', type=int, default=0)
+    parser.add_argument('--json', help='结果另外写到这个文件')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='水印工具性能测试')
+    sub = parser.add_subparsers(dest='command', required=True)
+    blend = sub.add_parser('blend', help='比较 pillow / numpy 混合')
+    blend.add_argument('--size', default='6000x4000', help='照片尺寸，默认 6000x4000')
+    blend.add_argument('--wm-size', type=int, default=15, help='水印宽度占照片的百分比')
+    blend.add_argument('--opacity', type=int, default=80)
+    blend.add_argument('--repeat', type=int, default=20)
+    blend.set_defaults(func=bench_blend)
+    tile = sub.add_parser('tile', help='平铺水印合成耗时')
+    tile.add_argument('--size', default='6000x4000', help='照片尺寸，默认 6000x4000')
+    tile.add_argument('--wm-size', type=int, default=10, help='水印宽度占照片的百分比')
+    tile.add_argument('--opacity', type=int, default=40)
+    tile.add_argument('--spacing', type=int, default=app.TILE_DEFAULTS['spacing'])
+    tile.add_argument('--angle', type=int, default=app.TILE_DEFAULTS['angle'])
+    tile.add_argument('--repeat', type=int, default=5)
+    tile.set_defaults(func=bench_tile)
+    export = sub.add_parser('export', help='完整导出流程的吞吐和延迟')
+    add_set_args(export)
+    export.add_argument('-j', '--workers', type=int, help='导出进程数，默认同 WM_EXPORT_WORKERS')
+    export.add_argument('--repeat', type=int, default=2, help='跑几轮，第一轮含进程池启动，默认 2')
+    export.set_defaults(func=bench_export)
+    stages = sub.add_parser('stages', help='逐步骤计时')
+    add_set_args(stages)
+    stages.set_defaults(func=bench_stages)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())